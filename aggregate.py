@@ -0,0 +1,98 @@
+# \file aggregate.py
+# (c) Matt Dugan
+#
+# \brief Groups and summarises a list of XML objects by a common key node
+
+import math
+import xmlio as ElementTree
+import elementpath
+
+TYPES=("group","count","sum","distinct")
+
+class Aggregate:
+  """\brief Groups and summarises a list of XML objects by a common key node
+
+  The Aggregate class implements the \a group, \a count, \a sum and
+  \a distinct types of the xdra:action directive.  Each makes one pass over
+  the items, placing them in a hash table by the value of their key node,
+  and returns new items for the getnode to render in place of the
+  matches.  Groups appear in the order their first item was matched.
+
+  \li \a group gives one <group> element per key holding a <key>, a
+  <count> and every item of the group
+  \li \a count gives one <group> per key with just its <key> and <count>
+  \li \a sum adds to each counted <group> the <sum> of the numeric text
+  of the \a value node of its items
+  \li \a distinct gives the first item matched for each key
+
+  Without a key, every item falls in one group whose <key> is empty.
+  Key values are the typed keys of sort.Sort.keys(), so the key columns
+  extracted for sorting are shared; the <key> shown for a group is the
+  text of the key node of its first item.
+  """
+
+  def __init__(self, sort):
+    """\brief Initializes an Aggregate sharing the key columns of \em sort
+
+    \param sort The sort.Sort whose extracted key columns are used
+    """
+    self.sort=sort
+
+  def apply(self, atype, datalist, key=None, keytype="text", value=None):
+    """\brief Performs the aggregate action \em atype on \em datalist
+
+    \param atype One of "group", "count", "sum" or "distinct"
+    \param datalist a list of nodes in response to a query/action/getnode triplet
+    \param key (None) the tag name of the node to group by
+    \param keytype ("text") how key values compare, see sort.Sort.keys()
+    \param value (None) the tag name of the node summed by a \a sum action
+    \return a new list of nodes to render
+    """
+    if key:
+      keys=self.sort.keys(datalist,key,keytype)
+    else:
+      keys=[None]*len(datalist)
+    groups={} #key value: list of items
+    order=[]
+    for keyvalue, item in zip(keys,datalist):
+      members=groups.get(keyvalue)
+      if members is None:
+        members=groups[keyvalue]=[]
+        order.append(keyvalue)
+      members.append(item)
+    if atype=="distinct":
+      return [groups[keyvalue][0] for keyvalue in order]
+    keypath=key and elementpath.compile(".//"+key)
+    valuepath=atype=="sum" and value and elementpath.compile(".//"+value)
+    result=[]
+    for keyvalue in order:
+      members=groups[keyvalue]
+      group=ElementTree.Element("group")
+      node=ElementTree.SubElement(group,"key")
+      if keypath: node.text=keypath.findtext(members[0])
+      ElementTree.SubElement(group,"count").text=str(len(members))
+      if atype=="sum":
+        ElementTree.SubElement(group,"sum").text=self._total(members,valuepath)
+      elif atype=="group":
+        for item in members:
+          group.append(item)
+      result.append(group)
+    return result
+
+  def _total(self, members, path):
+    """\brief Returns the sum of the numeric \em path texts as a string
+
+    Texts that are missing, not numbers or not finite (nan, inf) are left
+    out of the sum.  Whole sums are written without a fractional part; a
+    sum that overflows is written as inf.
+    """
+    total=0
+    if path:
+      for item in members:
+        try:
+          value=float(path.findtext(item) or "")
+        except ValueError:
+          continue
+        if not (math.isnan(value) or math.isinf(value)): total+=value
+    if math.isinf(total) or total!=int(total): return repr(total)
+    return str(int(total))
@@ -3,7 +3,75 @@
 #
 # \brief Keeps a cache of objects with md5 checksums
 
-import md5
+import md5, os, cPickle, threading
+
+class LRUDict(dict):
+	"""\brief A dictionary holding at most \a maxsize entries
+
+	LRUDict behaves like a plain dictionary, but remembers when each key
+	was last stored or read (with [] or get()).  Storing a new key while
+	\a maxsize entries are held first drops the least recently used tenth
+	of them.  A \a maxsize of 0 never drops anything.  It is used for the
+	parsed file, document, output and model caches that long running
+	processes would otherwise grow without limit.
+	"""
+
+	def __init__(self, maxsize=0):
+		"""\brief Initializes an empty dictionary
+
+		\param maxsize (0) The most entries to hold, 0 for no limit
+		"""
+		dict.__init__(self)
+		self.maxsize=maxsize
+		self.used={} #key: tick of the last use
+		self.tick=0
+		self.lock=threading.Lock()
+
+	def _touch(self, key):
+		self.tick+=1
+		self.used[key]=self.tick
+
+	def __getitem__(self, key):
+		value=dict.__getitem__(self, key)
+		self._touch(key)
+		return value
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __setitem__(self, key, value):
+		if self.maxsize and len(self)>=self.maxsize and not dict.has_key(self, key):
+			self.evict(len(self)-self.maxsize+1+self.maxsize/10)
+		dict.__setitem__(self, key, value)
+		self._touch(key)
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self.used.pop(key, None)
+
+	def pop(self, key, *default):
+		self.used.pop(key, None)
+		return dict.pop(self, key, *default)
+
+	def clear(self):
+		dict.clear(self)
+		self.used.clear()
+
+	def evict(self, count):
+		"""\brief Drops the \em count least recently used entries"""
+		self.lock.acquire()
+		try:
+			order=[(tick, key) for key, tick in self.used.items()]
+			order.sort()
+			for tick, key in order[:count]:
+				# another thread may have dropped it already
+				dict.pop(self, key, None)
+				self.used.pop(key, None)
+		finally:
+			self.lock.release()
 
 class Cache:
 	"""\brief Keeps a cache of objects with md5 checksums
@@ -22,17 +90,16 @@ class Cache:
 		"""\brief Initialize a new cache object
 		
 		Creates an attribute \a cache as a dictionary to store objects
-		matched by a key (an md5 checksum string).  \em maxsize is present
-		to limit the cache to less than a specific number of commonly
-		reference elements, but it is currently not enforced, since no
-		method to perform access profiling is currently implemented in this
-		module.
+		matched by a key (an md5 checksum string).  \em maxsize limits the
+		cache to that many objects; once it is full, the least recently
+		used objects are dropped to make room, see LRUDict.
 		
 		\a cache The dictionary of key: object pairs
-		\param maxsize The maximum size of the cache, currently not enforced.
+		\param maxsize (0) The maximum number of objects, 0 for no limit
 		"""
-		self.cache={}
-		self.__maxsize=maxsize #currently not enforced, need use profiling first
+		self.cache=LRUDict(maxsize)
+		self.maxsize=maxsize
+		self.groups=LRUDict(maxsize) #group: key of its current version
 
 	def getkey(self, keytext):
 		"""\brief Retrieve an md5 checksum based on the value \em keytext
@@ -45,7 +112,7 @@ class Cache:
 		\param keytext The object to generate a new md5 checksum from
 		\return the md5 checksum string
 		"""
-		key=md5.new(keytext)
+		key=md5.new(keytext).hexdigest()
 		return key
 			
 	def add(self, item, key=None):
@@ -62,10 +129,26 @@ class Cache:
 		\return the key used to place \em item in the cache
 		"""
 		if not key:
-			key=md5.new(item)
+			key=md5.new(item).hexdigest()
 		self.cache[key]=item
 		return key
 
+	def supersede(self, group, key):
+		"""\brief Makes \em key the current version of \em group
+
+		Objects which are versions of the same thing, such as the outputs
+		of one model for successive versions of its sources, can be put in
+		a group.  The object previously current for \em group is removed,
+		so stale versions do not linger until they are evicted.
+
+		\param group A key naming the group, such as a getkey() checksum
+		\param key The key of the newly added version
+		"""
+		old=self.groups.get(group)
+		self.groups[group]=key
+		if old is not None and old!=key:
+			self.remove(old)
+
 	def remove(self, key):
 		"""\brief Removes an object from the cache
 		
@@ -112,3 +195,102 @@ class Cache:
 			return self.cache[key]
 		except:
 			return None
+
+class DiskCache(Cache):
+	"""\brief Keeps a cache of objects on disk, one pickle per key
+
+	DiskCache has the same interface as Cache, but every object is pickled
+	into its own file below \a path, named by its key.  This lets separate
+	runs of a program, such as successive cron invocations, share cached
+	objects.  Keys should be the md5 checksum strings from \em getkey().
+	"""
+
+	def __init__(self, path, maxsize=0):
+		"""\brief Initialize a new disk cache in directory \em path
+
+		The directory is created if it does not exist yet.  With a
+		\em maxsize, adding an object to a full cache removes the files
+		least recently added or retrieved.
+
+		\param path The directory in which the cached objects are stored
+		\param maxsize (0) The maximum number of objects, 0 for no limit
+		"""
+		Cache.__init__(self, maxsize)
+		self.path=path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def add(self, item, key=None):
+		"""\brief Adds a new object to the cache, writing it to disk
+
+		\param item The object to add to the cache
+		\param key Use as the key for \em item in the cache
+		\return the key used to place \em item in the cache
+		"""
+		if not key:
+			key=md5.new(item).hexdigest()
+		filename=os.path.join(self.path, key)
+		fp=open(filename+".tmp", 'wb')
+		cPickle.dump(item, fp, 2)
+		fp.close()
+		os.rename(filename+".tmp", filename) # readers never see partial files
+		if self.maxsize: self.evict()
+		return key
+
+	def evict(self):
+		"""\brief Removes the least recently used files above \a maxsize
+
+		Files are aged by their modification time, which \em retrieve()
+		updates, and the oldest are removed until a tenth of the cache is
+		free.
+		"""
+		try:
+			names=[name for name in os.listdir(self.path) if not name.endswith(".tmp")]
+		except OSError:
+			return
+		if len(names)<=self.maxsize: return
+		order=[]
+		for name in names:
+			try:
+				order.append((os.stat(os.path.join(self.path, name)).st_mtime, name))
+			except OSError:
+				pass # removed by another process
+		order.sort()
+		for mtime, name in order[:len(order)-self.maxsize+self.maxsize/10]:
+			self.remove(name)
+
+	def remove(self, key):
+		"""\brief Removes an object from the cache and from disk
+
+		\param key The key corresponding to the object to remove
+		"""
+		try:
+			os.remove(os.path.join(self.path, key))
+		except:
+			return
+
+	def contains(self, key):
+		"""\brief Checks for the existence of a key: object pair on disk
+
+		\param key The key to match in the cache
+		\return True or False if the key is matched or not
+		"""
+		return os.path.isfile(os.path.join(self.path, key))
+
+	def retrieve(self, key):
+		"""\brief Retrieves the object having a particular key from disk
+
+		\param key The key to match in the cache
+		\return the object matching key or None if not found
+		"""
+		try:
+			filename=os.path.join(self.path, key)
+			fp=open(filename, 'rb')
+			try:
+				item=cPickle.load(fp)
+			finally:
+				fp.close()
+			if self.maxsize: os.utime(filename, None) # mark as recently used
+			return item
+		except:
+			return None
@@ -0,0 +1,254 @@
+# \file columnar.py
+# (c) Matt Dugan
+#
+# \brief Column stores for tabular sources, exposed as lightweight elements
+
+import csv, json
+import xmlio as ElementTree
+import elementpath
+
+class ColumnStore:
+  """\brief Keeps a table as one list of values per column
+
+  Tabular sources (CSV, TSV and JSON lines) are read with bulk readers and
+  transposed into \a columns, one list per field in \a names, instead of
+  building an element per row and per cell.  The rows are exposed to the
+  model through a ColumnSource root whose children are RowView objects,
+  which behave like elements closely enough for getnode, getcontent, sort
+  and serialization.
+  """
+
+  def __init__(self, names, columns, rowtag="row"):
+    """\brief Initializes a store from column names and column lists
+
+    \param names The list of field names
+    \param columns A list of value lists, one per name, all of equal length
+    \param rowtag ("row") The tag of the elements each row appears as
+    """
+    self.names=list(names)
+    self.columns=columns
+    self.rowtag=rowtag
+    self.index=dict([(name, column) for column, name in enumerate(self.names)])
+    if columns: self.rowcount=len(columns[0])
+    else: self.rowcount=0
+
+  def value(self, row, column):
+    """\brief Returns the text of one cell, or None if it is empty
+
+    \param row The row number
+    \param column The column number
+    \return the cell text, or None
+    """
+    value=self.columns[column][row]
+    if value is None or isinstance(value, basestring): return value
+    return json.dumps(value)
+
+def readDelimited(stream, delimiter=",", header=True, fields=None,
+    rowtag="row", wanted=None):
+  """\brief Reads a delimited text table into a ColumnStore
+
+  The whole table is read by csv.reader and transposed in one go.  Rows
+  shorter than the longest row are padded with empty cells.
+
+  \param stream A file-like object to read the table from
+  \param delimiter (",") The field delimiter
+  \param header (True) Take the field names from the first row
+  \param fields (None) The field names, overriding or replacing the header
+  \param rowtag ("row") The tag of the elements each row appears as
+  \param wanted (None) A dictionary of the only field names to keep
+  \return a new ColumnStore
+  """
+  rows=list(csv.reader(stream, delimiter=delimiter))
+  names=fields
+  if header and rows:
+    names=names or [name.strip() for name in rows[0]]
+    rows=rows[1:]
+  if not names:
+    width=max([0]+[len(row) for row in rows])
+    names=["field%d"%(count+1) for count in range(width)]
+  width=len(names)
+  if rows:
+    rows=[row+[None]*(width-len(row)) for row in rows if row]
+    columns=[list(column) for column in zip(*rows)[:width]]
+  else:
+    columns=[[] for name in names]
+  return _store(names, columns, rowtag, wanted)
+
+def readJSONLines(stream, fields=None, rowtag="row", wanted=None):
+  """\brief Reads a JSON lines table, one object per line, into a ColumnStore
+
+  Field names are taken from \em fields or, if not given, from the keys
+  of the objects in the order they are first seen.  Blank lines are
+  skipped.
+
+  \param stream A file-like object to read the table from
+  \param fields (None) The field names to read
+  \param rowtag ("row") The tag of the elements each row appears as
+  \param wanted (None) A dictionary of the only field names to keep
+  \return a new ColumnStore
+  """
+  rows=[json.loads(line) for line in stream if line.strip()]
+  names=fields
+  if not names:
+    names=[]
+    seen={}
+    for row in rows:
+      for name in row.keys():
+        if not seen.has_key(name):
+          seen[name]=1
+          names.append(name)
+  columns=[[row.get(name) for row in rows] for name in names]
+  return _store([str(name) for name in names], columns, rowtag, wanted)
+
+def _store(names, columns, rowtag, wanted):
+  """\brief Makes a ColumnStore, dropping columns not in \em wanted"""
+  if wanted is not None:
+    kept=[(name, column) for name, column in zip(names, columns)
+        if wanted.has_key(name)]
+    names=[name for name, column in kept]
+    columns=[column for name, column in kept]
+  return ColumnStore(names, columns, rowtag)
+
+class FieldView(object):
+  """\brief One cell of a ColumnStore, looking like a text-only element"""
+
+  __slots__=("store", "row", "column")
+
+  def __init__(self, store, row, column):
+    self.store=store
+    self.row=row
+    self.column=column
+
+  tag=property(lambda self: self.store.names[self.column])
+  attrib=property(lambda self: {})
+  tail=None
+
+  def _gettext(self):
+    return self.store.value(self.row, self.column)
+
+  def _settext(self, text):
+    self.store.columns[self.column][self.row]=text
+
+  text=property(_gettext, _settext)
+
+  def __len__(self):
+    return 0
+
+  def __getitem__(self, index):
+    raise IndexError(index)
+
+  def getchildren(self):
+    return []
+
+  def get(self, key, default=None):
+    return default
+
+  def keys(self):
+    return []
+
+  def items(self):
+    return []
+
+  def getiterator(self, tag=None):
+    if tag is None or tag=="*" or tag==self.tag:
+      return [self]
+    return []
+
+  def find(self, path):
+    return None
+
+  def findtext(self, path):
+    return None
+
+  def findall(self, path):
+    return []
+
+class RowView(object):
+  """\brief One row of a ColumnStore, looking like an element per field
+
+  A RowView holds nothing but its store and row number.  Field children
+  are made on demand, and paths naming a single field (./title, title or
+  .//title) are answered straight from the column without making any.
+  Empty cells have no child, like a missing element.
+  """
+
+  __slots__=("store", "row")
+
+  def __init__(self, store, row):
+    self.store=store
+    self.row=row
+
+  tag=property(lambda self: self.store.rowtag)
+  attrib=property(lambda self: {})
+  text=None
+  tail=None
+
+  def getchildren(self):
+    store=self.store
+    row=self.row
+    return [FieldView(store, row, column)
+        for column in range(len(store.names))
+        if store.columns[column][row] is not None]
+
+  def __len__(self):
+    return len(self.getchildren())
+
+  def __getitem__(self, index):
+    return self.getchildren()[index]
+
+  def get(self, key, default=None):
+    return default
+
+  def keys(self):
+    return []
+
+  def items(self):
+    return []
+
+  def getiterator(self, tag=None):
+    nodes=[]
+    if tag is None or tag=="*" or tag==self.tag:
+      nodes.append(self)
+    for node in self.getchildren():
+      nodes.extend(node.getiterator(tag))
+    return nodes
+
+  def _column(self, path):
+    """\brief Returns the column a simple field path names, or None"""
+    compiled=elementpath.compile(path)
+    tags=getattr(compiled, "tags", None)
+    if tags and len(tags)==1:
+      return self.store.index.get(tags[0])
+    return None
+
+  def find(self, path):
+    column=self._column(path)
+    if column is None:
+      return elementpath.compile(path).find(self)
+    if self.store.columns[column][self.row] is None: return None
+    return FieldView(self.store, self.row, column)
+
+  def findtext(self, path):
+    column=self._column(path)
+    if column is None:
+      return elementpath.compile(path).findtext(self)
+    return self.store.value(self.row, column)
+
+  def findall(self, path):
+    if self._column(path) is None:
+      return elementpath.compile(path).findall(self)
+    node=self.find(path)
+    if node is None: return []
+    return [node]
+
+class ColumnSource(ElementTree._ElementInterface):
+  """\brief The root of a tabular source, with one RowView child per row
+
+  \param tag The tag of the source root, the source name
+  \param store The ColumnStore holding the rows
+  """
+
+  def __init__(self, tag, store):
+    ElementTree._ElementInterface.__init__(self, tag, {})
+    self.store=store
+    self._children=[RowView(store, row) for row in xrange(store.rowcount)]
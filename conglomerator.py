@@ -4,8 +4,134 @@
 # \brief Brings several xml files into one big xmlio object
 
 
-import os, glob, operator
+import os, glob, operator, time
 import xmlio as ElementTree
+import columnar, hooks, cache
+
+class Projection:
+  """\brief Describes which parts of a source a model can possibly read
+
+  A projection names the \a items a model's paths step through (every
+  tag of every query and getnode path), the \a fields read directly below
+  an item (by getcontent paths and path predicates), and the
+  \a descendants searched for anywhere below an item (such as sort keys).
+  Everything outside of items is always kept, so paths leading to items
+  still match.  Inside an item only field children (with their whole
+  subtree), descendant tags and nested items are kept; see
+  ProjectingTreeBuilder.
+  """
+
+  def __init__(self, items, fields, descendants):
+    """\brief Initializes a projection from three lists of tags
+
+    \param items Tags of the elements on getnode and query paths
+    \param fields Tags of item children read by getcontent paths and predicates
+    \param descendants Tags searched for at any depth below an item
+    """
+    self.items=dict.fromkeys(items)
+    self.fields=dict.fromkeys(fields)
+    self.descendants=dict.fromkeys(descendants)
+    tags=[list(items),list(fields),list(descendants)]
+    for taglist in tags: taglist.sort()
+    self.key=repr(tags)
+
+class ProjectingTreeBuilder(ElementTree.TreeBuilder):
+  """\brief A TreeBuilder that only builds the elements a projection needs
+
+  Expat still reads the whole document, but elements inside an item that
+  the projection does not name are skipped, along with their text.  When
+  an element that is needed (a nested item or a descendant tag) turns up
+  below skipped elements, those skipped ancestors are built after all,
+  as bare elements without text, so every kept element keeps its real
+  path and paths through the skipped levels match exactly as they would
+  in the complete document.
+  """
+
+  OUTSIDE, ITEM, FIELD, SKIP = range(4)
+
+  def __init__(self, projection):
+    """\brief Initializes the builder for \em projection
+
+    \param projection The Projection deciding which elements are built
+    """
+    ElementTree.TreeBuilder.__init__(self)
+    self.projection=projection
+    self.states=[] #[state, tag, attrs, built] of every open element
+
+  def start(self, tag, attrs):
+    projection=self.projection
+    if not self.states:
+      parent=self.OUTSIDE
+    else:
+      parent=self.states[-1][0]
+    if parent==self.OUTSIDE:
+      state=projection.items.has_key(tag) and self.ITEM or self.OUTSIDE
+    elif parent==self.FIELD:
+      state=self.FIELD
+    elif projection.items.has_key(tag):
+      state=self.ITEM
+    elif parent==self.ITEM and projection.fields.has_key(tag):
+      state=self.FIELD
+    elif projection.descendants.has_key(tag):
+      state=self.FIELD
+    else:
+      state=self.SKIP
+    if state==self.SKIP:
+      self.states.append([state, tag, attrs, False])
+      return None
+    self._buildSkipped()
+    self.states.append([state, tag, attrs, True])
+    return ElementTree.TreeBuilder.start(self, tag, attrs)
+
+  def _buildSkipped(self):
+    """\brief Builds the skipped elements enclosing the element being started"""
+    pending=[]
+    for entry in reversed(self.states):
+      if entry[3]: break
+      pending.append(entry)
+    for entry in reversed(pending):
+      ElementTree.TreeBuilder.start(self, entry[1], entry[2])
+      entry[3]=True
+
+  def end(self, tag):
+    if self.states.pop()[3]:
+      return ElementTree.TreeBuilder.end(self, tag)
+
+  def data(self, data):
+    if not self.states or self.states[-1][0]!=self.SKIP:
+      self._data.append(data)
+
+def newStats(stype, name, path):
+  """\brief Returns an empty load statistics record for one source
+
+  Records describe one source declaration: its \a type, \a name and
+  \a path, the seconds spent reading (\a fetch) and parsing (\a parse)
+  it, the \a bytes read, the \a elements and \a attributes of the
+  trees built, the \a peak number of elements in any one tree, how many
+  files came from the tree cache (\a cached), whether the whole document
+  was a \a shared one built earlier, and a list of per file records with
+  the same measures in \a files.
+
+  \param stype The source type ("files", "url", "csv", ...)
+  \param name The root name of the source
+  \param path The path of the source, or None
+  \return a dictionary
+  """
+  return {"type":stype, "name":name, "path":path, "fetch":0.0, "parse":0.0,
+      "bytes":0, "elements":0, "attributes":0, "peak":0, "cached":0,
+      "shared":False, "files":[]}
+
+def countTree(tree):
+  """\brief Returns the number of elements and attributes in \em tree
+
+  \param tree The root element of a tree
+  \return an (elements, attributes) pair
+  """
+  elements=attributes=0
+  for node in tree.getiterator():
+    elements+=1
+    attributes+=len(node.attrib)
+  return (elements,attributes)
 
 class FileInput:
   """\brief Brings several xml files into one big xmlio object
@@ -16,31 +142,82 @@ class FileInput:
   new XML tree is given as a parameter and the tree is returned after all
   .xml files have been sucessfully parsed and their contents added to the
   XML tree.  The filelist is kept in case it needs to be re-referenced.
+
+  Every call to \em getDocObj() or \em getTableObj() leaves a record of
+  what loading the source cost in \a stats, see newStats().
   """
 
-  def __init__(self):
+  def __init__(self, shared=False):
     """\brief Initializes a new FileInput session
 
     Creates a file list to hold the absolute paths of the filenames
     found by the wildcard match and sets up the XML doc to be used
-    later by a call to /em getDocObj().
+    later by a call to /em getDocObj().  Parsed files are kept in
+    \a treecache along with their modification time and size so that a
+    long running process only re-parses the files that actually changed;
+    at most \a treecache.maxsize trees are kept, the least recently used
+    are dropped first.
+    When \em shared is set, identical source declarations (same path,
+    root name, recursion and type) return the document built the first
+    time, which lets many models rendered in one process load each source
+    only once; \a doccache likewise keeps the most recently used
+    documents.  While \a caching is off, as in a run over its memory
+    budget, trees and documents already cached are still re-used but new
+    ones are not kept, so they are freed once the model stops using them.
+
+    \param shared (False) Re-use documents for identical declarations
     """
     self.filelist=[]
     self.doc=None
+    self.treecache=cache.LRUDict(10000) #filename: ((mtime,size), tree, sizes)
+    self.shared=shared
+    self.doccache=cache.LRUDict(100) #(path,rootname,recursive,url): (doc, stats)
+    self.caching=True #keep new trees and documents, see ModelParser.checkMemory()
+    self.stats=None #load statistics of the last source, see newStats()
+
+  def fork( self ):
+    """\brief Returns a new FileInput sharing this one's caches
+
+    The file list and current document are per call state, so a context
+    loading sources at the same time as another needs a FileInput of its
+    own.  The fork shares \a treecache and \a doccache, so files parsed by
+    either are not parsed again.
+
+    \return a new FileInput
+    """
+    fileinput=FileInput(self.shared)
+    fileinput.treecache=self.treecache
+    fileinput.doccache=self.doccache
+    fileinput.caching=self.caching
+    return fileinput
 
-  def getDocObj( self, path, rootname, recursive=False, url=False ):
+  def getDocObj( self, path, rootname, recursive=False, url=False, projection=None ):
     """\brief Retrieves an XML object for *.xml in /em path
 
     Returns an in-memory document object representing the combined
     contents of several files on disk, where the search is (optionally)
     recursive, and appends the parsed content of each XML file to the
-    parent document having the tag \em rootname.
+    parent document having the tag \em rootname.  The time, bytes and
+    tree sizes of the load are recorded in \a stats, per file and in
+    total.
 
     \param path The path at which to start the search
     \param rootname The name of the root node of the output XML tree
     \param recursive A boolean defining whether a recursive search should be performed.
+    \param url A boolean defining whether \em path is a single URL
+    \param projection (None) A Projection limiting the elements that are
+    built, or None to build the complete documents
     \return the aggregated output XML document object
     """
+    self.stats=newStats(url and "url" or "files",rootname,path)
+    if self.shared:
+      key=(path,rootname,bool(recursive),bool(url),projection and projection.key)
+      shared=self.doccache.get(key)
+      if shared:
+        if hooks.enabled: hooks.emit("fileinput.shared",path=path,name=rootname)
+        self._shareStats(shared[1])
+        self.doc=shared[0]
+        return self.doc
     self.doc = ElementTree.Element(rootname)
     tree=None
     if not url:
@@ -48,14 +225,214 @@ class FileInput:
         self._getFilesRecursive( path )
       else:
         self._getFiles( path )
+      if hooks.enabled: hooks.emit("fileinput.files",path=path,
+          recursive=bool(recursive),files=len(self.filelist))
       for filename in self.filelist:
-        tree = ElementTree.XML( self._openanything(filename).read() )
-        self.doc.append(tree)
+        self.doc.append(self._getTree(filename,projection))
     else:
-      tree=ElementTree.XML( self._openanything(path).read() )
+      if hooks.enabled: hooks.emit("fileinput.url",url=path)
+      start=time.time()
+      text=self._openanything(path).read()
+      fetched=time.time()
+      tree=self._parse( text, projection )
+      self._addStats(path,(len(text),)+countTree(tree),fetched-start,
+          time.time()-fetched,False)
       self.doc.append(tree)
+    if self.shared and self.caching:
+      self.doccache[key]=(self.doc,self.stats)
     return self.doc
 
+  def getVersion( self, path, recursive=False, url=False ):
+    """\brief Returns a version fingerprint for a source without loading it
+
+    For file sources the fingerprint lists every matching .xml file with
+    its modification time and size; a path naming a single file, as for
+    table sources, lists just that file.  For URL sources a HEAD request is
+    made and the ETag and Last-Modified validators are returned.  A source
+    whose version cannot be determined, such as a URL served without any
+    validators, or a path matching no file at all, returns \em None,
+    meaning it must always be loaded again.
+
+    \param path The path or URL of the source
+    \param recursive A boolean defining whether a recursive search should be performed.
+    \param url A boolean defining whether \em path is a single URL
+    \return a hashable fingerprint, or None if it cannot be determined
+    """
+    if url:
+      import urllib2
+      request=urllib2.Request(path)
+      request.get_method=lambda: "HEAD"
+      try:
+        response=urllib2.urlopen(request)
+        headers=response.info()
+        response.close()
+      except (IOError, OSError, ValueError):
+        return None
+      validators=(headers.getheader("ETag"),headers.getheader("Last-Modified"))
+      if validators==(None,None): return None
+      return validators
+    if os.path.isfile(path):
+      st=os.stat(path)
+      return ((path,st.st_mtime,st.st_size),)
+    if recursive:
+      self._getFilesRecursive( path )
+    else:
+      self._getFiles( path )
+    version=[]
+    for filename in self.filelist:
+      try:
+        st=os.stat(filename)
+      except OSError:
+        return None
+      version.append((filename,st.st_mtime,st.st_size))
+    if not version and not os.path.isdir(path): return None
+    version.sort()
+    return tuple(version)
+
+  def getTableObj( self, path, rootname, format="csv", rowtag="row",
+      header=True, fields=None, projection=None ):
+    """\brief Retrieves a tabular file as a column backed XML object
+
+    Reads a CSV, TSV or JSON lines file into a columnar.ColumnStore and
+    returns a columnar.ColumnSource root tagged \em rootname, with one
+    lightweight row view per record instead of an element per cell.
+    Stores are kept in \a treecache like parsed XML files and are only
+    read again when the file's modification time or size change.  In the
+    load statistics each row counts as one element with a child per
+    stored column, and the table's reading and parsing are both timed as
+    \a parse.
+
+    \param path The path or URL of the table
+    \param rootname The name of the root node of the output XML tree
+    \param format ("csv") One of "csv", "tsv" or "jsonl"
+    \param rowtag ("row") The tag of the element each record appears as
+    \param header (True) Take delimited field names from the first line
+    \param fields (None) A list of field names, overriding the header
+    \param projection (None) A Projection; when \em rowtag is one of its
+    items, columns the model never reads are not stored
+    \return the ColumnSource for the table
+    """
+    wanted=None
+    if projection and projection.items.has_key(rowtag):
+      wanted=projection.fields.copy()
+      wanted.update(projection.descendants)
+    key=("table",path,format,rowtag,bool(header),fields and tuple(fields),
+        projection and projection.key)
+    self.stats=newStats(format,rootname,path)
+    shared=self.shared and self.doccache.get(key)
+    if shared:
+      self._shareStats(shared[1])
+      self.doc=shared[0]
+      return self.doc
+    try:
+      st=os.stat(path)
+      stamp=(st.st_mtime,st.st_size)
+    except OSError:
+      stamp=None
+    cached=self.treecache.get(key)
+    if stamp and cached and cached[0]==stamp:
+      store=cached[1]
+      if hooks.enabled: hooks.emit("fileinput.table",path=path,cached=True)
+      self._addStats(path,cached[2],0.0,0.0,True)
+    else:
+      if hooks.enabled: hooks.emit("fileinput.table",path=path,cached=False)
+      start=time.time()
+      stream=self._openanything(path)
+      if format=="jsonl":
+        store=columnar.readJSONLines(stream,fields,rowtag,wanted)
+      else:
+        store=columnar.readDelimited(stream,format=="tsv" and "\t" or ",",
+            header,fields,rowtag,wanted)
+      stream.close()
+      sizes=(stamp and stamp[1] or 0,store.rowcount*(1+len(store.names)),0)
+      self._addStats(path,sizes,0.0,time.time()-start,False)
+      if stamp and self.caching: self.treecache[key]=(stamp,store,sizes)
+    self.doc=columnar.ColumnSource(rootname,store)
+    if self.shared and self.caching:
+      self.doccache[key]=(self.doc,self.stats)
+    return self.doc
+
+  def _addStats( self, name, sizes, fetch, parse, cached ):
+    """\brief Adds the record of one file or url to \a stats
+
+    \param name The filename or url that was loaded
+    \param sizes A (bytes, elements, attributes) tuple, or None if unknown
+    \param fetch The seconds spent reading it
+    \param parse The seconds spent parsing it
+    \param cached Whether its tree came from \a treecache
+    """
+    stats=self.stats
+    if stats is None: return
+    size, elements, attributes = sizes or (0,0,0)
+    stats["files"].append({"name":name, "bytes":size, "elements":elements,
+        "attributes":attributes, "fetch":fetch, "parse":parse, "cached":cached})
+    stats["bytes"]+=size
+    stats["elements"]+=elements
+    stats["attributes"]+=attributes
+    stats["peak"]=max(stats["peak"],elements)
+    stats["fetch"]+=fetch
+    stats["parse"]+=parse
+    if cached: stats["cached"]+=1
+
+  def _shareStats( self, first ):
+    """\brief Fills \a stats for a document re-used from \a doccache
+
+    The sizes are those of the first load, \em first; nothing was read
+    or parsed this time, so the times are zero and the file records are
+    left out.
+    """
+    for name in ("bytes","elements","attributes","peak"):
+      self.stats[name]=first[name]
+    self.stats["shared"]=True
+
+
+  def _getTree( self, filename, projection=None ):
+    """\brief Returns the parsed tree for \em filename, re-using the cache
+
+    The file is only read and parsed when it is not in \a treecache or
+    when its modification time or size differ from the cached copy.
+    Trees built under different projections are cached separately.
+
+    \param filename The path of the XML file to parse
+    \param projection (None) A Projection limiting the elements that are built
+    \return the root element of the parsed file
+    """
+    try:
+      st=os.stat(filename)
+      stamp=(st.st_mtime,st.st_size)
+    except OSError:
+      stamp=None
+    if projection: key=(filename,projection.key)
+    else: key=filename
+    cached=self.treecache.get(key)
+    if stamp and cached and cached[0]==stamp:
+      if hooks.enabled: hooks.emit("fileinput.file",filename=filename,cached=True)
+      self._addStats(filename,cached[2],0.0,0.0,True)
+      return cached[1]
+    if hooks.enabled: hooks.emit("fileinput.file",filename=filename,cached=False,
+        projection=projection and projection.key)
+    start=time.time()
+    text=self._openanything(filename).read()
+    fetched=time.time()
+    tree = self._parse( text, projection )
+    sizes=(len(text),)+countTree(tree)
+    self._addStats(filename,sizes,fetched-start,time.time()-fetched,False)
+    if stamp and self.caching: self.treecache[key]=(stamp,tree,sizes)
+    return tree
+
+  def _parse( self, text, projection=None ):
+    """\brief Parses \em text, building only what \em projection needs
+
+    \param text The XML document as a string
+    \param projection (None) A Projection limiting the elements that are built
+    \return the root element of the parsed document
+    """
+    if not projection:
+      return ElementTree.XML( text )
+    parser=ElementTree.XMLTreeBuilder(target=ProjectingTreeBuilder(projection))
+    parser.feed(text)
+    return parser.close()
+
   def _getFilesRecursive( self, path ):
     """\brief Performs the recursive matching operation to \em filelist
 
@@ -65,6 +442,7 @@ class FileInput:
 
     \param path The path at which to start the search
     """
+    self.filelist=[]
     for root, dirs, files in os.walk( path ):
       for name in files:
         if name.endswith('.xml'):
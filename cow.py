@@ -0,0 +1,218 @@
+# \file cow.py
+# (c) Matt Dugan
+#
+# \brief Copy-on-write views of source elements for custom actions
+
+import xmlio as ElementTree
+import elementpath
+
+class CowElement(object):
+  """\brief A copy-on-write proxy for an element of a source tree
+
+  Reading a CowElement (its tag, text, attributes and children, or any
+  find) reads the wrapped element directly.  The first change made
+  through it (setting tag, text or tail, set(), append() and the other
+  list operations, or touching \a attrib, which may be changed in place)
+  gives the proxy a private shallow copy of the element, and all further
+  reads and changes go to the copy, so the source tree is never modified.
+  Children are handed out wrapped in CowElements of their own, the same
+  proxy each time, so a change deep inside an item only copies the
+  elements actually changed.  As with an element, changing the list
+  returned by getchildren() changes the children: before the first change
+  it is a ChildList, which makes the copy when it is changed, and after it
+  the copy's own list.
+  """
+
+  __slots__=("_original", "_copy", "_wrapped")
+
+  def __init__(self, element):
+    """\brief Wraps \em element
+
+    \param element The source element to read through to
+    """
+    object.__setattr__(self, "_original", element)
+    object.__setattr__(self, "_copy", None)
+    object.__setattr__(self, "_wrapped", {}) #id(child): (child, proxy)
+
+  def _target(self):
+    """\brief Returns the element reads go to, the copy once there is one"""
+    if self._copy is not None: return self._copy
+    return self._original
+
+  def _write(self):
+    """\brief Returns the private copy, making it on the first change"""
+    if self._copy is None:
+      original=self._original
+      element=ElementTree.Element(original.tag, dict(original.items()))
+      element.text=original.text
+      element.tail=original.tail
+      element._children=[self._wrap(child) for child in original.getchildren()]
+      object.__setattr__(self, "_copy", element)
+    return self._copy
+
+  def _wrap(self, child):
+    """\brief Returns the proxy for \em child, making it the first time"""
+    if isinstance(child, CowElement): return child
+    entry=self._wrapped.get(id(child))
+    if entry is None:
+      entry=self._wrapped[id(child)]=(child, CowElement(child))
+    return entry[1]
+
+  def modified(self):
+    """\brief Tells whether anything was changed through this proxy
+
+    \return True if this element or any wrapped descendant was copied
+    """
+    if self._copy is not None: return True
+    for child, proxy in self._wrapped.values():
+      if proxy.modified(): return True
+    return False
+
+  def __getattr__(self, name):
+    if name=="attrib":
+      return self._write().attrib
+    if name=="_children":
+      return self._write()._children
+    return getattr(self._target(), name)
+
+  def __setattr__(self, name, value):
+    setattr(self._write(), name, value)
+
+  def __repr__(self):
+    return "<CowElement %r>" % (self._target(),)
+
+  def __len__(self):
+    return len(self._target())
+
+  def __getitem__(self, index):
+    return self._wrap(self._target()[index])
+
+  def __setitem__(self, index, element):
+    self._write()[index]=element
+
+  def __delitem__(self, index):
+    del self._write()[index]
+
+  def __getslice__(self, start, stop):
+    return [self._wrap(child) for child in self._target()[start:stop]]
+
+  def __setslice__(self, start, stop, elements):
+    self._write()[start:stop]=elements
+
+  def __delslice__(self, start, stop):
+    del self._write()[start:stop]
+
+  def makeelement(self, tag, attrib):
+    return ElementTree.Element(tag, attrib)
+
+  def append(self, element):
+    self._write().append(element)
+
+  def insert(self, index, element):
+    self._write().insert(index, element)
+
+  def remove(self, element):
+    self._write().remove(element)
+
+  def clear(self):
+    self._write().clear()
+
+  def set(self, key, value):
+    self._write().set(key, value)
+
+  def get(self, key, default=None):
+    return self._target().get(key, default)
+
+  def keys(self):
+    return self._target().keys()
+
+  def items(self):
+    return self._target().items()
+
+  def getchildren(self):
+    if self._copy is not None: return self._copy._children
+    return ChildList(self, [self._wrap(child) for child in self._original.getchildren()])
+
+  def getiterator(self, tag=None):
+    nodes=[]
+    if tag is None or tag=="*" or tag==self.tag:
+      nodes.append(self)
+    for node in self.getchildren():
+      nodes.extend(node.getiterator(tag))
+    return nodes
+
+  def find(self, path):
+    return elementpath.compile(path).find(self)
+
+  def findtext(self, path):
+    return elementpath.compile(path).findtext(self)
+
+  def findall(self, path):
+    return elementpath.compile(path).findall(self)
+
+def _change(name):
+  """\brief Returns a ChildList method applying list method \em name to the copy"""
+  def change(self, *args, **kwargs):
+    children=self._owner._write()._children
+    result=getattr(children, name)(*args, **kwargs)
+    list.__setitem__(self, slice(None), children)
+    if result is children: return self
+    return result
+  return change
+
+class ChildList(list):
+  """\brief The children of an unchanged CowElement, as getchildren() lists them
+
+  Reading the list reads the wrapped children.  Changing it (append(),
+  remove(), sort(), item assignment and the other list operations) gives
+  its CowElement a private copy, applies the change to the copy's
+  children and leaves this list equal to them, so scripts may change an
+  item's children through getchildren() as they would an element's.
+  """
+
+  def __init__(self, owner, children):
+    """\brief Initializes the list of \em owner's \em children
+
+    \param owner The CowElement the children belong to
+    \param children The wrapped children
+    """
+    list.__init__(self, children)
+    self._owner=owner
+
+  for _name in ("append", "extend", "insert", "remove", "pop", "sort",
+      "reverse", "__setitem__", "__delitem__", "__setslice__",
+      "__delslice__", "__iadd__"):
+    locals()[_name]=_change(_name)
+  del _name
+
+class ItemView(ElementTree._ElementInterface):
+  """\brief The xdra_tree of a custom action, holding the matched items
+
+  ItemView looks like an element tagged "root" whose children are the
+  items matched by the getnode, each wrapped in a CowElement, so a script
+  can read, reorder, remove, change and add items without re-parenting
+  them or changing the source trees they came from.
+  """
+
+  def __init__(self, items):
+    """\brief Initializes the view over \em items
+
+    \param items The list of matched items
+    """
+    ElementTree._ElementInterface.__init__(self, "root", {})
+    self._children=[CowElement(item) for item in items]
+
+  def results(self):
+    """\brief Returns the items left in the view after the script ran
+
+    Items the script did not change are returned as the original source
+    elements; changed items are returned as their CowElement.
+
+    \return a list of items
+    """
+    items=[]
+    for item in self._children:
+      if isinstance(item, CowElement) and not item.modified():
+        item=item._original
+      items.append(item)
+    return items
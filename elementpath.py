@@ -45,11 +45,91 @@
 import re
 
 xpath_tokenizer = re.compile(
-    "(::|\.\.|\(\)|[/.*:\[\]\(\)@=])|((?:\{[^}]+\})?[^/:\[\]\(\)@=\s]+)|\s+"
+    "('[^']*'|\"[^\"]*\")|"
+    "(::|\.\.|\(\)|[/.*:\[\]\(\)@=])|"
+    "((?:\{[^}]+\})?[^/:\[\]\(\)@=\s'\"]+)|\s+"
     ).findall
 
-class xpath_descendant_or_self:
-    pass
+##
+# (Internal) A single location step: an axis, a tag test and a list
+# of predicates.  The axis is either "child" or "descendant"; the
+# latter matches the tag at any depth below the context node (the
+# step following a //).  Predicates are tuples:
+# <ul>
+# <li>("position", n) - the n'th match (1-based) below its parent</li>
+# <li>("attribute", name, value) - attribute present, or equal to value</li>
+# <li>("child", tag, value) - child present, or with text equal to value</li>
+# </ul>
+# A value of None only tests for presence.
+
+class _Step:
+
+    def __init__(self, axis, tag):
+        self.axis = axis
+        self.tag = tag
+        self.predicates = []
+
+    ##
+    # Yield every node selected by this step from each node in nodes,
+    # in document order.  Predicates are applied while matching, and
+    # positions are counted per parent element.
+
+    def select(self, nodes):
+        tag = self.tag
+        if tag == "*":
+            tag = None
+        predicates = self.predicates
+        for context in nodes:
+            if self.axis == "child":
+                pairs = ((context, node) for node in context)
+            else:
+                pairs = _walk(context)
+            counters = {}
+            for parent, node in pairs:
+                if tag is not None and node.tag != tag:
+                    continue
+                for predicate in predicates:
+                    if not _test(predicate, parent, node, counters):
+                        break
+                else:
+                    yield node
+
+##
+# (Internal) Walk all descendants of element in document order,
+# yielding (parent, node) pairs without building intermediate lists.
+
+def _walk(element):
+    stack = [(element, iter(element))]
+    while stack:
+        parent, children = stack[-1]
+        for node in children:
+            yield parent, node
+            stack.append((node, iter(node)))
+            break
+        else:
+            stack.pop()
+
+##
+# (Internal) Apply a single predicate to node.  Positional predicates
+# count the nodes that reached them, per parent, in counters.
+
+def _test(predicate, parent, node, counters):
+    kind = predicate[0]
+    if kind == "position":
+        key = (id(parent), id(predicate))
+        count = counters.get(key, 0) + 1
+        counters[key] = count
+        return count == predicate[1]
+    if kind == "attribute":
+        value = node.get(predicate[1])
+        if predicate[2] is None:
+            return value is not None
+        return value == predicate[2]
+    for child in node:
+        if child.tag == predicate[1]:
+            if predicate[2] is None or (child.text or "") == predicate[2]:
+                return 1
+    return 0
 
 ##
 # Wrapper for a compiled XPath.
@@ -57,36 +137,219 @@ class xpath_descendant_or_self:
 class Path:
 
     ##
-    # Create an Path instance from an XPath expression.
+    # Create an Path instance from an XPath expression.  Besides
+    # 'tag/tag' and '//' steps, the supported syntax includes the
+    # predicates [n], [@attr], [@attr='value'], [tag] and
+    # [tag='text'], and a final text() step selecting element text.
 
     def __init__(self, path):
         tokens = xpath_tokenizer(path)
-        # the current version supports 'path/path'-style expressions only
-        self.path = []
+        self.steps = []
+        self.text = 0
         self.tag = None
-        if tokens and tokens[0][0] == "/":
+        if tokens and tokens[0][1] == "/":
             raise SyntaxError("cannot use absolute path on element")
+        axis = "child"
         while tokens:
-            op, tag = tokens.pop(0)
+            string, op, tag = tokens.pop(0)
+            if tag == "text" and tokens and tokens[0][1] == "()":
+                tokens.pop(0)
+                if tokens:
+                    raise SyntaxError("text() must be the last step")
+                self.text = 1
+                break
             if tag or op == "*":
-                self.path.append(tag or op)
+                step = _Step(axis, tag or op)
+                axis = "child"
+                while tokens and tokens[0][1] == "[":
+                    tokens.pop(0)
+                    step.predicates.append(self._predicate(tokens))
+                self.steps.append(step)
             elif op == ".":
                 pass
             elif op == "/":
-                self.path.append(xpath_descendant_or_self())
+                axis = "descendant"
                 continue
             else:
-                raise SyntaxError("unsupported path syntax (%s)" % op)
+                raise SyntaxError("unsupported path syntax (%s)" % (op or string))
             if tokens:
-                op, tag = tokens.pop(0)
+                string, op, tag = tokens.pop(0)
                 if op != "/":
                     raise SyntaxError(
-                        "expected path separator (%s)" % (op or tag)
+                        "expected path separator (%s)" % (op or tag or string)
                         )
-        if self.path and isinstance(self.path[-1], xpath_descendant_or_self):
+        if axis == "descendant":
             raise SyntaxError("path cannot end with //")
-        if len(self.path) == 1 and isinstance(self.path[0], type("")):
-            self.tag = self.path[0]
+        if len(self.steps) == 1 and not self.text:
+            step = self.steps[0]
+            if step.axis == "child" and step.tag != "*" and not step.predicates:
+                self.tag = step.tag
+        self._specialise()
+
+    ##
+    # (Internal) Choose a specialised evaluator for simple paths.  A
+    # path made only of plain tag steps, with at most its first step
+    # following a //, is evaluated by dedicated findall/find/findtext
+    # methods that work on child lists directly, without generators,
+    # predicate checks or per-step type tests.  Every other path keeps
+    # the general step engine.
+
+    def _specialise(self):
+        if self.text or not self.steps:
+            return
+        for step in self.steps:
+            if step.tag == "*" or step.predicates:
+                return
+        for step in self.steps[1:]:
+            if step.axis != "child":
+                return
+        self.tags = [step.tag for step in self.steps]
+        if self.steps[0].axis == "descendant":
+            self.findall = self._findall_descendant
+            self.find = self._find_descendant
+        elif len(self.tags) == 1:
+            self.findall = self._findall_child
+            return # find and findtext already use self.tag
+        else:
+            self.findall = self._findall_chain
+            self.find = self._find_chain
+        self.findtext = self._findtext_first
+
+    ##
+    # (Internal) Find all, for a single child tag such as ./title.
+
+    def _findall_child(self, element):
+        tag = self.tag
+        return [node for node in element.getchildren() if node.tag == tag]
+
+    ##
+    # (Internal) Find all, for a chain of child tags such as a/b/c.
+
+    def _findall_chain(self, element, start=0):
+        nodeset = [element]
+        for tag in self.tags[start:]:
+            nodeset = [node for parent in nodeset
+                       for node in parent.getchildren() if node.tag == tag]
+            if not nodeset:
+                return []
+        return nodeset
+
+    ##
+    # (Internal) Find first, for a chain of child tags.  The chain is
+    # followed depth first, so the search stops at the first match.
+
+    def _find_chain(self, element, start=0):
+        tags = self.tags
+        last = len(tags) - 1
+        def first(parent, index):
+            tag = tags[index]
+            for node in parent.getchildren():
+                if node.tag == tag:
+                    if index == last:
+                        return node
+                    node = first(node, index + 1)
+                    if node is not None:
+                        return node
+            return None
+        if start > last:
+            return element
+        return first(element, start)
+
+    ##
+    # (Internal) Find all, for //tag optionally followed by child tags,
+    # such as .//item or .//rss/channel/item.
+
+    def _findall_descendant(self, element):
+        tag = self.tags[0]
+        nodeset = []
+        append = nodeset.append
+        def walk(parent):
+            for node in parent.getchildren():
+                if node.tag == tag:
+                    append(node)
+                if node.getchildren():
+                    walk(node)
+        walk(element)
+        if len(self.tags) == 1:
+            return nodeset
+        return [node for parent in nodeset
+                for node in self._findall_chain(parent, 1)]
+
+    ##
+    # (Internal) Find first, for //tag optionally followed by child tags.
+
+    def _find_descendant(self, element):
+        tag = self.tags[0]
+        stack = [iter(element.getchildren())]
+        while stack:
+            for node in stack[-1]:
+                if node.tag == tag:
+                    found = self._find_chain(node, 1)
+                    if found is not None:
+                        return found
+                stack.append(iter(node.getchildren()))
+                break
+            else:
+                stack.pop()
+        return None
+
+    ##
+    # (Internal) Find text, for any specialised path.
+
+    def _findtext_first(self, element):
+        node = self.find(element)
+        if node is None:
+            return None
+        return node.text
+
+    ##
+    # (Internal) Parse the body of a predicate, after the opening [.
+
+    def _predicate(self, tokens):
+        # whitespace is insignificant between the parts of a predicate
+        end = 0
+        while end < len(tokens) and tokens[end][1] != "]":
+            end = end + 1
+        tokens[:end] = [token for token in tokens[:end] if token != ("", "", "")]
+        try:
+            string, op, tag = tokens.pop(0)
+            if tag and tag.isdigit():
+                predicate = ("position", int(tag))
+            else:
+                kind = "child"
+                if op == "@":
+                    kind = "attribute"
+                    string, op, tag = tokens.pop(0)
+                if not tag:
+                    raise SyntaxError("expected name in predicate (%s)" %
+                                      (op or string))
+                value = None
+                if tokens[0][1] == "=":
+                    tokens.pop(0)
+                    value = tokens.pop(0)[0]
+                    if not value:
+                        raise SyntaxError("expected quoted value in predicate")
+                    value = value[1:-1]
+                predicate = (kind, tag, value)
+            if tokens.pop(0)[1] != "]":
+                raise SyntaxError("expected ] after predicate")
+        except IndexError:
+            raise SyntaxError("unterminated predicate")
+        return predicate
+
+    ##
+    # Iterate over all matching objects, in document order.  Matches
+    # are produced one at a time, so callers that stop early never
+    # visit the rest of the tree.  With a final text() step, the text
+    # of each match is produced instead.
+
+    def iterfind(self, element):
+        nodeset = iter([element])
+        for step in self.steps:
+            nodeset = step.select(nodeset)
+        if self.text:
+            return (node.text for node in nodeset)
+        return nodeset
 
     ##
     # Find first matching object.
@@ -94,10 +357,9 @@ class Path:
     def find(self, element):
         tag = self.tag
         if tag is None:
-            nodeset = self.findall(element)
-            if not nodeset:
-                return None
-            return nodeset[0]
+            for node in self.iterfind(element):
+                return node
+            return None
         for elem in element:
             if elem.tag == tag:
                 return elem
@@ -109,10 +371,11 @@ class Path:
     def findtext(self, element):
         tag = self.tag
         if tag is None:
-            nodeset = self.findall(element)
-            if not nodeset:
-                return None
-            return nodeset[0].text
+            for node in self.iterfind(element):
+                if self.text:
+                    return node
+                return node.text
+            return None
         for elem in element:
             if elem.tag == tag:
                 return elem.text
@@ -122,53 +385,90 @@ class Path:
     # Find all matching objects.
 
     def findall(self, element):
-        nodeset = [element]
-        index = 0
-        while 1:
-            try:
-                path = self.path[index]
-                index = index + 1
-            except IndexError:
-                return nodeset
-            set = []
-            if isinstance(path, xpath_descendant_or_self):
-                try:
-                    tag = self.path[index]
-                    if not isinstance(tag, type("")):
-                        tag = None
-                    else:
-                        index = index + 1
-                except IndexError:
-                    tag = None # invalid path
-                for node in nodeset:
-                    new = list(node.getiterator(tag))
-                    if new and new[0] is node:
-                        set.extend(new[1:])
-                    else:
-                        set.extend(new)
-            else:
-                for node in nodeset:
-                    for node in node:
-                        if path == "*" or node.tag == path:
-                            set.append(node)
-            if not set:
-                return []
-            nodeset = set
+        return list(self.iterfind(element))
 
-_cache = {}
+##
+# (Internal) Bounded cache of compiled paths.  Every lookup stamps
+# the path with a tick; when the cache is full, the least recently
+# used tenth of the entries is evicted in one go, which keeps hits
+# down to two dictionary operations.  Hits and misses are counted.
+
+class _PathCache:
+
+    def __init__(self, maxsize=1000):
+        self.paths = {}
+        self.used = {}
+        self.tick = 0
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        self.tick = self.tick + 1
+        p = self.paths.get(path)
+        if p is not None:
+            self.hits = self.hits + 1
+            self.used[path] = self.tick
+            return p
+        self.misses = self.misses + 1
+        p = Path(path)
+        if len(self.paths) >= self.maxsize:
+            self.evict(len(self.paths) - self.maxsize + 1 + self.maxsize / 10)
+        self.paths[path] = p
+        self.used[path] = self.tick
+        return p
+
+    def evict(self, count):
+        order = [(tick, path) for path, tick in self.used.items()]
+        order.sort()
+        for tick, path in order[:count]:
+            # another thread may have evicted it already
+            self.paths.pop(path, None)
+            self.used.pop(path, None)
+
+_cache = _PathCache()
 
 ##
 # (Internal) Compile path.
 
 def _compile(path):
-    p = _cache.get(path)
-    if p is not None:
-        return p
-    p = Path(path)
-    if len(_cache) >= 100:
-        _cache.clear()
-    _cache[path] = p
-    return p
+    return _cache.get(path)
+
+##
+# Compile a path ahead of use.  The compiled path is kept in the
+# path cache, and is also returned so that callers evaluating the
+# same path many times can hold on to it.
+#
+# @param path A path expression.
+# @return A compiled Path instance.
+# @exception SyntaxError If the path is not supported.
+
+def compile(path):
+    return _cache.get(path)
+
+##
+# Set the maximum number of compiled paths kept in the cache.
+#
+# @param maxsize The new maximum, at least 1.
+
+def setcachesize(maxsize):
+    _cache.maxsize = max(1, maxsize)
+    if len(_cache.paths) > _cache.maxsize:
+        _cache.evict(len(_cache.paths) - _cache.maxsize)
+
+##
+# Get path cache statistics.
+#
+# @return A dictionary with the hits, misses, hit rate, current size
+#     and maximum size of the compiled path cache.
+
+def cachestats():
+    lookups = _cache.hits + _cache.misses
+    rate = 0.0
+    if lookups:
+        rate = float(_cache.hits) / lookups
+    return {"hits": _cache.hits, "misses": _cache.misses, "rate": rate,
+            "size": len(_cache.paths), "maxsize": _cache.maxsize}
 
 ##
 # Find first matching object.
@@ -188,3 +488,8 @@ def findtext(element, path):
 def findall(element, path):
     return _compile(path).findall(element)
 
+##
+# Iterate over all matching objects.
+
+def iterfind(element, path):
+    return _compile(path).iterfind(element)
@@ -4,7 +4,7 @@
 # \brief Runs embedded python code in custom xdra:source or xdra:action elements
 
 import xmlio as ElementTree
-import cache
+import cache, hooks
 
 class Executor:
 	"""\brief Runs embedded python code in custom xdra:source or xdra:action elements
@@ -13,10 +13,10 @@ class Executor:
 	that appears in xdra:source or xdra:action directives while using the
 	\a custom attribute.  The compiled byte-code objects are stored in a cache
 	according to an md5 hash of their source code and retrieved dynamically so
-	that the byte-code compiling process is not recurring.  The execution is
-	done in a local context, so two variables are available to the process:
-	xdra_tree and xdra_outtext.  In addition, all system libraries and the
-	XML object library are available.
+	that the byte-code compiling process is not recurring.  Each run gets a
+	fresh namespace of its own, holding the xdra_ variables of the directive
+	and the XML object library as ElementTree, which the script's functions
+	see as their globals.  In addition, all system libraries can be imported.
 	"""
 
 	def __init__(self, name=None, code=None, tree=None):
@@ -37,6 +37,22 @@ class Executor:
 		self.setTree(tree)
 		self.out=None
 		self.key=None
+		self.rows=None
+		self.projection=None
+
+	def fork(self):
+		"""\brief Returns a new Executor sharing this one's code cache
+
+		An Executor holds the name, code and tree of the script it is about
+		to run, so a context running scripts at the same time as another
+		needs an Executor of its own.  The fork starts empty but shares the
+		compiled code objects, so no script is compiled twice.
+
+		\return a new Executor
+		"""
+		runner=Executor()
+		runner.__execCache=self.__execCache
+		return runner
 
 	def setName(self, name):
 		"""\brief Sets the name attribute to the current Executor context
@@ -75,6 +91,14 @@ class Executor:
 			self.code=code.replace('\r\n','\n') # 2-byte returns break execution.
 			self.key=self.__execCache.getkey(code)
 
+	def getkey(self, code):
+		"""\brief Returns the md5 hash the code cache would use for \em code
+
+		\param code the source code of an embedded python script
+		\return a md5 hash string representing the source code
+		"""
+		return self.__execCache.getkey(code.replace('\r\n','\n'))
+
 	def runAction(self):
 		"""\brief Executes code given within a custom xdra:action directive
 
@@ -89,15 +113,17 @@ class Executor:
 
 		\return any output text stored into the predefined xdra_outtext variable
 		"""
-		xdra_tree=self.tree
-		xdra_outtext=""
+		namespace={"ElementTree":ElementTree,"xdra_tree":self.tree,
+			"xdra_outtext":""}
 		if not self.__execCache.contains(self.key):
+			if hooks.enabled: hooks.emit("executor.compile",name=self.name,key=self.key)
 			self.out = compile(self.code,'<string>','exec')
 			self.__execCache.add(self.out,self.key)
 		else:
 			self.out = self.__execCache.retrieve(self.key)
-		exec(self.out)
-		return xdra_outtext
+		if hooks.enabled: hooks.emit("executor.action",name=self.name,key=self.key)
+		exec self.out in namespace
+		return namespace.get("xdra_outtext")
 
 	def runSource(self):
 		"""\brief Executes code given within a custom xdra:source directive
@@ -111,16 +137,26 @@ class Executor:
 		into the cache.  Next, the code is executed and the XML object tree
 		which should be populated by the code execution is returned.
 
+		Instead of populating xdra_tree up front, the code may bind
+		xdra_rows to an iterable (typically a generator) of elements or
+		rows, which is kept in \a rows so that the caller can consume it
+		lazily.  The projection of the model, if any, is available to the
+		code as xdra_projection so that it can skip fields nobody reads.
+
 		\return the modified XML object source tree
 		"""
-		xdra_tree=self.tree
+		namespace={"ElementTree":ElementTree,"xdra_tree":self.tree,
+			"xdra_rows":None,"xdra_projection":self.projection}
 		if not self.__execCache.contains(self.key):
+			if hooks.enabled: hooks.emit("executor.compile",name=self.name,key=self.key)
 			self.out = compile(self.code,'<string>','exec')
 			self.__execCache.add(self.out,self.key)
 		else:
-			self.out = __execCache.retrieve(self.key)
-		exec(self.out)
-		return xdra_tree
+			self.out = self.__execCache.retrieve(self.key)
+		if hooks.enabled: hooks.emit("executor.source",name=self.name,key=self.key)
+		exec self.out in namespace
+		self.rows=namespace.get("xdra_rows")
+		return namespace.get("xdra_tree")
 
 if __name__=="__main__":
 	"""\brief test main for Executor
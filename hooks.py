@@ -0,0 +1,107 @@
+# \file hooks.py
+# (c) Matt Dugan
+#
+# \brief Structured trace events from the parser and its helpers
+
+import os, sys, time, threading
+
+enabled=False #True while at least one tracer is installed
+_tracers=[]
+
+class Event:
+  """\brief One trace event, with lazily computed fields
+
+  Every event has a dotted \a name (such as "source.load" or
+  "sort.spill"), the \a time it was emitted, the name of the \a thread
+  that emitted it, and a set of named fields.  A field may be given as a
+  function of no arguments, which is only called, once, when a tracer
+  reads that field; expensive values such as the serialized form of a
+  source tree are passed this way so that they cost nothing unless
+  asked for.
+  """
+
+  def __init__(self, name, fields):
+    """\brief Initializes an event
+
+    \param name The dotted name of the event
+    \param fields A dictionary of field values or functions computing them
+    """
+    self.name=name
+    self.time=time.time()
+    self.thread=threading.currentThread().getName()
+    self.fields=fields
+
+  def __getitem__(self, key):
+    value=self.fields[key]
+    if callable(value):
+      value=self.fields[key]=value()
+    return value
+
+  def get(self, key, default=None):
+    if not self.fields.has_key(key): return default
+    return self[key]
+
+  def keys(self):
+    return self.fields.keys()
+
+  def items(self):
+    """\brief Returns every (field, value) pair, computing lazy values"""
+    return [(key, self[key]) for key in self.fields.keys()]
+
+class PrintTracer:
+  """\brief Writes every event it receives as one line of text
+
+  \param stream (sys.stdout) The file-like object to write to
+  \param lazy (True) Also compute and write the lazily given fields;
+  when False they are written as "..."
+  """
+
+  def __init__(self, stream=None, lazy=True):
+    self.stream=stream or sys.stdout
+    self.lazy=lazy
+
+  def __call__(self, event):
+    fields=[]
+    keys=event.keys()
+    keys.sort()
+    for key in keys:
+      if self.lazy or not callable(event.fields[key]):
+        fields.append("%s=%s"%(key, event[key]))
+      else:
+        fields.append("%s=..."%key)
+    self.stream.write("%s %s\n"%(event.name, " ".join(fields)))
+
+def install(tracer):
+  """\brief Starts sending every event to \em tracer
+
+  \param tracer A function (or callable object) taking one Event
+  """
+  global enabled
+  _tracers.append(tracer)
+  enabled=True
+
+def uninstall(tracer):
+  """\brief Stops sending events to \em tracer
+
+  \param tracer A tracer given to \em install()
+  """
+  global enabled
+  if tracer in _tracers: _tracers.remove(tracer)
+  enabled=bool(_tracers)
+
+def emit(eventname, **fields):
+  """\brief Sends an event to every installed tracer
+
+  Callers test \em enabled first, as in
+  "if hooks.enabled: hooks.emit("query", path=path)", so that nothing,
+  not even the field dictionary, is built while no tracer is installed.
+
+  \param eventname The dotted name of the event
+  \param fields The fields of the event, see Event
+  """
+  event=Event(eventname, fields)
+  for tracer in list(_tracers):
+    tracer(event)
+
+if os.environ.get("DEBUG"):
+  install(PrintTracer())
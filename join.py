@@ -0,0 +1,89 @@
+# \file join.py
+# (c) Matt Dugan
+#
+# \brief Correlates a list of XML objects with the items of another source
+
+import xmlio as ElementTree
+import elementpath
+
+class Join:
+  """\brief Correlates a list of XML objects with the items of another source
+
+  The Join class implements the \a join type of the xdra:action directive.
+  The items of the joined source are placed in a hash index by the text of
+  their key node, built once, and every matched item of the getnode then
+  looks up its own match node in the index, so correlating n items with m
+  others takes n+m lookups instead of n*m comparisons.
+
+  Indexes are kept in \a indexes for the rest of the model run, so several
+  queries joining the same source on the same key share one.  Like the key
+  columns of sort.Sort they hold the items they describe and must be
+  dropped with \em invalidate() whenever items may have been modified.
+  """
+
+  def __init__(self):
+    """\brief Initializes a Join with no indexes"""
+    self.indexes={} #(id(source), path, key): (source, {text: [items]})
+
+  def index(self, source, path, key):
+    """\brief Returns the hash index of the \em path items of \em source
+
+    \param source The root of the joined source
+    \param path The path of the joined items within \em source
+    \param key The path of the key node within each joined item
+    \return a dictionary mapping key texts to lists of items
+    """
+    entry=self.indexes.get((id(source),path,key))
+    if entry is not None: return entry[1]
+    keypath=elementpath.compile(key)
+    table={}
+    for item in elementpath.compile(path).findall(source):
+      text=keypath.findtext(item)
+      if text is None: continue
+      members=table.get(text.strip())
+      if members is None:
+        table[text.strip()]=[item]
+      else:
+        members.append(item)
+    self.indexes[(id(source),path,key)]=(source,table)
+    return table
+
+  def join(self, datalist, source, path, key, match=None, outer=False):
+    """\brief Joins every node of \em datalist with its items in \em source
+
+    For each node of \a datalist, in order, the text of its \a match node
+    is looked up in the index of \a source, and a joined element is made
+    for every item found: a new element with the tag, attributes and text
+    of the node, whose children are the node's children followed by the
+    joined item.  Nodes without a match are dropped, or kept as they are
+    when \a outer is set.
+
+    \param datalist a list of nodes in response to a query/action/getnode triplet
+    \param source The root of the joined source
+    \param path The path of the joined items within \em source
+    \param key The path of the key node within each joined item
+    \param match (None) The path of the key node within each node of
+    \a datalist, the same as \a key by default
+    \param outer (False) Keep the nodes that have no match
+    \return a new list of nodes to render
+    """
+    table=self.index(source,path,key)
+    matchpath=elementpath.compile(match or key)
+    result=[]
+    for item in datalist:
+      text=matchpath.findtext(item)
+      members=text is not None and table.get(text.strip())
+      if not members:
+        if outer: result.append(item)
+        continue
+      children=list(item.getchildren())
+      for member in members:
+        joined=ElementTree.Element(item.tag,dict(item.items()))
+        joined.text=item.text
+        joined._children=children+[member]
+        result.append(joined)
+    return result
+
+  def invalidate(self):
+    """\brief Drops every index"""
+    self.indexes={}
@@ -0,0 +1,166 @@
+# \file lazysource.py
+# (c) Matt Dugan
+#
+# \brief A source tree whose children are produced on demand
+
+import itertools
+import xmlio as ElementTree
+import elementpath
+
+class LazySource:
+  """\brief A source tree whose children are produced on demand
+
+  LazySource wraps the xdra_rows iterable bound by a custom xdra:source
+  script.  It behaves like the root element of an ordinary source tree,
+  but its children are only pulled from the iterable (and turned into
+  elements) as they are needed.  Iterating over the source, or matching
+  a path against it with \em iterfind(), consumes the rows one at a time,
+  so a getnode with a \a limit stops the script after that many matches.
+  Children already produced are kept, so the source may be queried again
+  later in the model; operations that need every child (len(),
+  getchildren(), getiterator(), append()) drain the rest of the rows.
+
+  Rows may be elements, dictionaries mapping field names to text, or
+  sequences of values named by \a fields.  Dictionary and sequence rows
+  become an element tagged \a rowtag with one child element per field.
+  When a projection is given and \a rowtag is one of its items, fields the
+  model never reads are left out of the element.
+  """
+
+  def __init__(self, tag, rows, rowtag="row", fields=None, projection=None):
+    """\brief Initializes a LazySource over an iterable of rows
+
+    \param tag The tag of the source root, the custom source name
+    \param rows An iterable of elements, dictionaries or sequences
+    \param rowtag ("row") The tag of elements made from non-element rows
+    \param fields (None) The field names of sequence rows
+    \param projection (None) A conglomerator.Projection of the model
+    """
+    self.tag=tag
+    self.attrib={}
+    self.text=None
+    self.tail=None
+    self.rowtag=rowtag
+    self.fields=fields or []
+    self.wanted=None
+    if projection and projection.items.has_key(rowtag):
+      self.wanted=projection.fields.copy()
+      self.wanted.update(projection.descendants)
+    self._rows=iter(rows)
+    self._children=[]
+
+  def _pull(self):
+    """\brief Produces the next child element, or None when exhausted"""
+    if self._rows is None: return None
+    try:
+      row=self._rows.next()
+    except StopIteration:
+      self._rows=None
+      return None
+    if not ElementTree.iselement(row):
+      row=self._element(row)
+    self._children.append(row)
+    return row
+
+  def _element(self, row):
+    """\brief Turns a dictionary or sequence row into an element"""
+    if hasattr(row, "items"):
+      pairs=row.items()
+    else:
+      pairs=zip(self.fields, row)
+    element=ElementTree.Element(self.rowtag)
+    wanted=self.wanted
+    for name, value in pairs:
+      if wanted is not None and not wanted.has_key(name): continue
+      field=ElementTree.SubElement(element, name)
+      if value is not None: field.text=str(value)
+    return element
+
+  def _drain(self):
+    """\brief Produces every remaining child"""
+    while self._rows is not None:
+      self._pull()
+
+  def __iter__(self):
+    index=0
+    while 1:
+      if index<len(self._children):
+        yield self._children[index]
+      elif self._pull() is None:
+        return
+      else:
+        continue
+      index+=1
+
+  def __len__(self):
+    self._drain()
+    return len(self._children)
+
+  def __getitem__(self, index):
+    if index<0: self._drain()
+    while index>=len(self._children) and self._pull() is not None:
+      pass
+    return self._children[index]
+
+  def getchildren(self):
+    self._drain()
+    return self._children
+
+  def append(self, element):
+    self._drain()
+    self._children.append(element)
+
+  def get(self, key, default=None):
+    return self.attrib.get(key, default)
+
+  def keys(self):
+    return self.attrib.keys()
+
+  def items(self):
+    return self.attrib.items()
+
+  def getiterator(self, tag=None):
+    nodes=[]
+    if tag is None or tag=="*" or tag==self.tag:
+      nodes.append(self)
+    for node in self.getchildren():
+      nodes.extend(node.getiterator(tag))
+    return nodes
+
+  def iterfind(self, path):
+    """\brief Lazily yields the elements matching \em path
+
+    \param path What element to look for
+    \return an iterator over the matching elements, in order
+    """
+    return elementpath.compile(path).iterfind(self)
+
+  def find(self, path):
+    for node in self.iterfind(path):
+      return node
+    return None
+
+  def findtext(self, path):
+    compiled=elementpath.compile(path)
+    for node in compiled.iterfind(self):
+      if compiled.text: return node
+      return node.text
+    return None
+
+  def findall(self, path):
+    return list(self.iterfind(path))
+
+def limited(source, path, limit):
+  """\brief Returns up to \em limit matches of \em path in \em source
+
+  Sources with an iterfind() method, like LazySource, are only consumed
+  as far as needed; other trees are matched with findall() and truncated.
+
+  \param source A source tree
+  \param path The path to match
+  \param limit The maximum number of matches to return
+  \return a list of at most \em limit matching elements
+  """
+  if hasattr(source, "iterfind"):
+    return list(itertools.islice(source.iterfind(path), limit))
+  return source.findall(path)[:limit]
@@ -0,0 +1,134 @@
+# \file memory.py
+# (c) Matt Dugan
+#
+# \brief Approximate memory accounting for a model run
+
+import tempfile
+
+ELEMENT=480 #approximate bytes of one parsed element, its dictionary and child list
+ATTRIBUTE=120 #approximate bytes of one attribute name and value
+ENTRY=100 #approximate bytes of one entry of a sort key column or join index
+
+class MemoryBudgetError(Exception):
+  """\brief Raised when a model run stays over its memory budget
+
+  The error is only raised once every other reaction (spilling the
+  output, evicting caches and streaming sources) has been tried.  Its
+  \a report holds the budget, the estimated usage by category, the
+  reactions taken and the largest sources; see ModelParser.memoryReport().
+  """
+
+  def __init__(self, message, report):
+    Exception.__init__(self, message)
+    self.report=report
+
+def treeBytes(size, elements, attributes):
+  """\brief Estimates the memory held by a parsed tree
+
+  \param size The bytes of text the tree was parsed from
+  \param elements The number of elements in the tree
+  \param attributes The number of attributes in the tree
+  \return the estimate in bytes
+  """
+  return size+(elements or 0)*ELEMENT+(attributes or 0)*ATTRIBUTE
+
+def statsBytes(stats):
+  """\brief Estimates the memory held by a source from its load statistics
+
+  \param stats A record made by conglomerator.newStats()
+  \return the estimate in bytes
+  """
+  return treeBytes(stats["bytes"],stats["elements"],stats["attributes"])
+
+def parseSize(text):
+  """\brief Converts a size such as "512M" into bytes
+
+  \param text A number of bytes, optionally followed by K, M or G
+  \return the number of bytes
+  """
+  text=text.strip().upper()
+  scale=1
+  if text[-1:] in ("K","M","G"):
+    scale=1024**("KMG".index(text[-1])+1)
+    text=text[:-1]
+  return int(float(text)*scale)
+
+class OutputBuffer:
+  """\brief Collects the output of a model, in memory or in a temporary file
+
+  The buffer starts in memory.  After \em spill() everything appended so
+  far, and everything appended later, goes to a temporary file instead,
+  which is read back piece by piece by \em chunks(), or at once by
+  \em getvalue(); unicode output is written to the file, and so read
+  back, as UTF-8.
+  """
+
+  def __init__(self):
+    """\brief Initializes an empty in-memory buffer"""
+    self.parts=[]
+    self.size=0 #bytes appended so far
+    self.file=None
+
+  def append(self, data):
+    """\brief Adds \em data to the end of the output"""
+    if self.file is None:
+      self.parts.append(data)
+    else:
+      self._write(data)
+    self.size+=len(data)
+
+  def _write(self, data):
+    """\brief Writes \em data to the file, unicode as UTF-8"""
+    if isinstance(data, unicode): data=data.encode("utf-8")
+    self.file.write(data)
+
+  def resident(self):
+    """\brief Returns the bytes of output held in memory"""
+    if self.file is None: return self.size
+    return 0
+
+  def spill(self):
+    """\brief Moves the output to a temporary file"""
+    if self.file is not None: return
+    self.file=tempfile.TemporaryFile()
+    for data in self.parts:
+      self._write(data)
+    self.parts=[]
+
+  def spilled(self):
+    """\brief Tells whether the output has been moved to a temporary file"""
+    return self.file is not None
+
+  def chunks(self, size=65536):
+    """\brief Yields the output in pieces, without joining it in memory
+
+    \param size (65536) The bytes per piece read back from the file
+    """
+    if self.file is None:
+      for data in self.parts:
+        yield data
+      return
+    self.file.seek(0)
+    while 1:
+      data=self.file.read(size)
+      if not data: return
+      yield data
+
+  def getvalue(self):
+    """\brief Returns the whole output as one string"""
+    if self.file is None: return "".join(self.parts)
+    self.file.seek(0)
+    data=self.file.read()
+    self.file.close()
+    self.file=None
+    self.parts=[data]
+    return data
+
+def formatSize(size):
+  """\brief Returns \em size in bytes as a short string such as "1.5M" """
+  if size<1024: return "%dB"%size
+  for unit in ("K","M"):
+    size/=1024.0
+    if size<1024: return "%.1f%s"%(size,unit)
+  size/=1024.0
+  return "%.1fG"%size
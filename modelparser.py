@@ -6,10 +6,9 @@
 
 
 import xmlio as ElementTree
-import conglomerator, sort, executor
-import os
-
-_debug = os.environ.get("DEBUG",0)
+import conglomerator, sort, aggregate, join, executor, cache, elementpath, lazysource, cow
+import profiler, hooks, memory
+import os, sys, itertools, copy, md5, time, threading
 
 class ModelParser:
   """\brief Parses the XDRA model document for commands
@@ -39,16 +38,37 @@ class ModelParser:
 
     Init requires no arguments, and simply sets up the parsing environment.
     These include empty lists for global, and local sources, an
-    instance of the code executor, and the default "tab size".  The only
-    attribute you may want to modify is \a tabSize which is set to 4 spaces
-    by default.
+    instance of the code executor, and the default "tab size".  The
+    attributes you may want to modify are \a tabSize which is set to 4
+    spaces by default, and \a cacheOutput which makes \em parseModel()
+    return a stored output when neither the model nor any of its sources
+    changed (see \em fingerprint()).  The stored outputs are kept in
+    \a outputs, which may be replaced by a cache.DiskCache to share them
+    between processes.  Outputs, parsed included models and parsed source
+    files are kept in caches of bounded size, see cache.LRUDict.
     """
     self.tabSize="    " #4 spaces
+    self.projectSources=True #build only the parts of sources a model reads
+    self.cacheOutput=False
+    self.outputs=cache.Cache(1000)
+    self.models=cache.LRUDict(100) #path: ((mtime,size), parsed model root)
+    self.parallel="auto" #source fan-out: auto, threads, processes or off
+    self.parallelThreshold=50000 #elements across sources before auto fans out
+    self.workers=4
+    self.spillRunSize=100000 #items per sorted run of a spilling sort
+    self.parallelQueries="auto" #independent queries: auto, threads, processes or off
+    self.profiler=None #a profiler.Profiler timing this parser, see instrument()
+    self.memoryBudget=None #bytes a model run may hold, see checkMemory()
+    self.pools={} #"threads": pool, "processes": (version, sources forked with, pool)
+    self.poolLock=threading.Lock() #guards pools, which forks and children share
+    self.parent=None #the context that included this model, see child()
     self.globalsources=globalsources
     self.localsources=localsources
     self.runner=executor.Executor()
     self.conglomerator=conglomerator.FileInput()
     self.sort=sort.Sort()
+    self.aggregate=aggregate.Aggregate(self.sort)
+    self.join=join.Join()
     self.reset()
 
   def reset(self, keepsources=False):
@@ -64,15 +84,37 @@ class ModelParser:
     this may be changed to \em True if multiple models should use the same
     sources without explicitly redeclaring them.
 
+    The worker pools of a parser that was not made by \em child() are
+    closed on a full reset, see \em closePools().
+
     \param keepsources (False) Clear the sources when the parser is reset
     """
     if not keepsources:
+      if self.parent is None: self.closePools()
       self.globalsources=[]
       self.localsources=[]
+      self.dependencies=[] #(path, recursive) pairs read by the model
+      self.sourceStats=[] #load statistics of each source, see addSourceStats()
+      self.streaming=False #project sources and spill sorts, see checkMemory()
+      self.reactions=[] #what checkMemory() did to stay within the budget
+      self.version=0 #bumped by every source declaration, see snapshot()
+      self.sort.invalidate()
+      self.join.invalidate()
     self.querypath=""
     self.level=0
     self.atype="" #the current action to be performed
     self.skey="" #a key to sort against for an action
+    self.keytype="text" #how sort keys compare, see sort.Sort.keys()
+    self.spill=None #items per run when the sort spills to disk, or None
+    self.svalue="" #the node summed by a sum action
+    self.joinspec=None #(source, path, key, match, outer) of a join action
+    self.record=None #(item, {path: text}) fields of the current getnode item
+    self.projection=None #conglomerator.Projection of the current model
+    self.orders={} #id(source): (source, elements in document order)
+    self.deferred=None #(query, snapshot, level) rendered after the model walk
+    self.getnodes=0 #getnode bodies being rendered, see deferQuery()
+    self.slotmark=None #brackets the slot numbers of deferred queries
+    self.output=None #memory.OutputBuffer of the model being parsed
 
   def parseXML(self,node,item=None):
     """\brief Parse and arbitrary XML node encountered in the model
@@ -105,53 +147,23 @@ class ModelParser:
       for child in node.getchildren():
         data=""
         if child.tag == self.sourceTAG:
-          if _debug: print "parseXML: calling parseSource for "+child.tag
           self.parseSource(child)
         elif child.tag == self.queryTAG:
-          if _debug: print "parseXML: calling parseQuery for "+child.tag
-          data=self.parseQuery(child)
+          data=self.deferQuery(child) or self.parseQuery(child)
         elif child.tag == self.literalTAG:
-          if _debug: print "parseXML: calling parseLiteral for "+child.tag
           data=self.parseLiteral(child)
         elif child.tag == self.actionTAG:
-          if _debug: print "parseXML: calling parseAction for "+child.tag
           data=self.parseAction(child)
         elif child.tag == self.getnodeTAG:
-          if _debug: print "parseXML: calling parseGetNode for "+child.tag
           data=self.parseGetNode(child)
           if data: datalist.append("\n")
         elif child.tag == self.getcontentTAG:
-          if _debug: print "parseXML: calling parseGetContent for "+child.tag
           data=self.parseGetContent(child,item)
           if data: datalist.append("\n")
         elif child.tag == self.modelTAG:
-          path=child.attrib.get("path")
-          if path:
-            try:
-              cmodel=ElementTree.parse(path).getroot()
-              if _debug: print "parseXML: calling parseModel for "+child.tag
-              #new instance just in case
-              parser=ModelParser(self.globalsources,self.localsources)
-              data=parser.parseModel(cmodel)
-              parser.reset() #just in case
-              print "Outputting data\n",data
-              if data: datalist.append("\n")
-            except:
-              if _debug: print "parseXML: invalid child model at "+path
-          elif not child.getchildren():
-            if _debug: print "parseXML: if no path, xdra:model must have children"
-          else:
-            try:
-              if _debug: print "parseXML: calling parseModel for "+child.tag
-              #new instance just in case
-              parser=ModelParser(self.globalsources,self.localsources)
-              data=parser.parseModel(child)
-              parser.reset() #just in case
-              if data: datalist.append("\n")
-            except:
-              if _debug: print "parseXML: invalid child model "+child.tag
+          data=self.parseSubModel(child)
+          if data: datalist.append("\n")
         else:
-          if _debug: print "parseXML: calling parseXML for "+child.tag
           data=self.parseXML(child,item)
         if data: datalist.append(data)
         #if child.tail: datalist.append(child.tail)
@@ -168,6 +180,8 @@ class ModelParser:
     individual source element according to the relative path given in the
     xdra:getcontent attributes.  Only the text is retrieved, not necessarily
     the full contents of the source node including sub-nodes (if they exist)
+    When \em parseGetNode() has already extracted the field into the
+    record of the current item, the text is taken from the record.
 
     \param node The current xdra:getcontent node
     \param source The current source item to retrieve text from
@@ -175,13 +189,388 @@ class ModelParser:
     """
     path = node.attrib.get("path")
     if not path:
-      if _debug: print "No path in parseGetContent"
+      if hooks.enabled: hooks.emit("getcontent.nopath")
       return None
-    if _debug: print "parseGetContent: calling source.findtext for "+path
+    record=self.record
+    if record is not None and record[0] is source and record[1].has_key(path):
+      if hooks.enabled: hooks.emit("getcontent",path=path,record=True,text=record[1][path])
+      return record[1][path]
     data = source.findtext(path)
-    if _debug: print data
+    if hooks.enabled: hooks.emit("getcontent",path=path,record=False,text=data)
     return data
 
+  def findMatches(self,path,sources,mode=None,limit=None,distinct=None):
+    """\brief Matches \em path against every source, merged in source order
+
+    Each source is matched independently, so with several sources the
+    work can be fanned out to a pool of \a workers.  \em mode (or the
+    parser's \a parallel attribute when the getnode gives none) selects
+    "threads", "processes", "off", or "auto", which uses processes once
+    the run's sources were loaded with more than \a parallelThreshold
+    elements in total (see \em sourceElements()).
+    Threads suit sources whose matching does not hold the interpreter
+    lock; plain element trees are pure Python, so their walks only run in
+    parallel in processes, and auto mode stays serial on a single CPU or
+    when the process runs other threads, which forking would not copy
+    safely (see \em _canFork()).  The process pool is forked after the
+    sources are loaded, so workers already hold the trees and only send
+    back the document order positions of their matches, which are mapped
+    onto the original elements here.  Pools are shared with forked and
+    child contexts, only one context at a time uses the process pool, and
+    they are closed when the run ends, see \em closePools().
+
+    With a \em limit, matching stops once that many items are found, and
+    lazy sources (see lazysource.LazySource) produce no more rows than
+    needed; lazy sources are never fanned out.  With \em distinct, only the
+    first of the items sharing a key is kept (see \em distinctItems()), and
+    the limit counts distinct items.
+
+    \param path The getnode path to match
+    \param sources The list of source trees to match against
+    \param mode (None) Overrides the parser's \a parallel attribute
+    \param limit (None) The maximum number of items to return
+    \param distinct (None) The key path items are deduplicated by
+    \return a list of all matched items
+    """
+    mode=mode or self.parallel
+    if limit is not None or [1 for source in sources
+        if isinstance(source,lazysource.LazySource)]:
+      mode="off"
+    if mode=="auto" and len(sources)>1 and self.workers>1 and _canFork():
+      if self.sourceElements()>self.parallelThreshold: mode="processes"
+    if distinct and (len(sources)<2 or mode not in ("threads","processes")):
+      return list(itertools.islice(
+          self.distinctItems(self.iterMatches(path,sources),distinct),limit))
+    itemlist=[]
+    if len(sources)<2 or mode not in ("threads","processes"):
+      for source in sources:
+        if limit is None:
+          itemlist.extend(source.findall(path))
+        elif len(itemlist)<limit:
+          itemlist.extend(lazysource.limited(source,path,limit-len(itemlist)))
+      if hooks.enabled: hooks.emit("matches",path=path,mode="off",
+          sources=len(sources),items=len(itemlist))
+      return itemlist
+    if hooks.enabled: hooks.emit("matches.fanout",path=path,mode=mode,sources=len(sources))
+    if mode=="threads":
+      results=self._threadPool("threads").map(_findall,
+          [(source,path) for source in sources])
+    else:
+      self.poolLock.acquire() #another context could replace the pool
+      try:
+        pool=self._forkPool(sources)
+        positions=pool.map(_findallShared,[(index,path) for index in range(len(sources))])
+      finally:
+        self.poolLock.release()
+      results=[]
+      for source, matches in zip(sources,positions):
+        order=self.documentOrder(source)
+        results.append([order[position] for position in matches])
+    for matches in results:
+      itemlist.extend(matches)
+    if distinct:
+      itemlist=list(self.distinctItems(itemlist,distinct))
+    return itemlist
+
+  def distinctItems(self,items,distinct):
+    """\brief Yields the items of \em items whose key was not seen before
+
+    The key of an item is the stripped text found at the path
+    \em distinct, or, when \em distinct is ".", an md5 checksum of the
+    item's content (tags, attributes and text, ignoring whitespace around
+    them), so identical items from overlapping sources are recognised.
+    Items without a key node are always kept.
+
+    \param items An iterable of matched items
+    \param distinct The key path, or "." to compare whole items
+    \return an iterator over the first item of every key, in order
+    """
+    seen={}
+    if distinct==".":
+      keyof=lambda item: md5.new(repr(_canonical(item))).hexdigest()
+    else:
+      keypath=elementpath.compile(distinct)
+      keyof=lambda item: keypath.findtext(item)
+    for item in items:
+      key=keyof(item)
+      if key is not None:
+        key=key.strip()
+        if seen.has_key(key): continue
+        seen[key]=1
+      yield item
+
+  def findSource(self,name):
+    """\brief Returns the declared source whose root is named \em name
+
+    \param name The name given to the source's xdra:source declaration
+    \return the root of the source, or None if there is no such source
+    """
+    for source in self.localsources+self.globalsources:
+      if source.tag==name: return source
+    return None
+
+  def iterMatches(self,path,sources):
+    """\brief Yields the matches of \em path in every source, one at a time
+
+    Sources with an iterfind() method, such as lazysource.LazySource, are
+    consumed as the matches are used, so a spilling sort (see
+    sort.Sort.spill()) never holds all of their rows at once.
+
+    \param path The getnode path to match
+    \param sources The list of source trees to match against
+    \return an iterator over the matched items, in source order
+    """
+    for source in sources:
+      if hasattr(source,"iterfind"):
+        matches=source.iterfind(path)
+      else:
+        matches=source.findall(path)
+      for item in matches:
+        yield item
+
+  def documentOrder(self,source):
+    """\brief Returns every element of \em source in document order
+
+    The list is built once per source and run, and doubles as the size
+    of the source and as the map from positions to elements used by
+    process workers in \em findMatches().
+
+    \param source A source tree
+    \return the list of elements of the tree, in document order
+    """
+    cached=self.orders.get(id(source))
+    if cached and cached[0] is source: return cached[1]
+    order=source.getiterator()
+    self.orders[id(source)]=(source,order)
+    return order
+
+  def independent(self,node):
+    """\brief Tells whether the xdra:query \em node can be rendered apart
+
+    A query is independent of the rest of the model when nothing in it
+    declares sources, includes models or runs custom action code, since
+    those change what later parts of the model see or have side effects
+    that must happen in document order.  Sort, aggregate and join actions
+    only read their sources, which never change while a model runs.
+
+    \param node The xdra:query element
+    \return True if the query can be rendered out of order
+    """
+    for child in node.getiterator():
+      if child.tag in (self.sourceTAG,self.modelTAG):
+        return False
+      if child.tag==self.actionTAG and child.attrib.get("type")=="custom":
+        return False
+    return True
+
+  def deferQuery(self,node):
+    """\brief Defers the xdra:query \em node if it can be rendered apart
+
+    While \em parseModel() collects deferred queries, an independent query
+    outside of any getnode body is recorded with a snapshot of the sources
+    and the current indentation level, to be rendered by
+    \em renderDeferred(), and a slot marking its place in the output is
+    returned instead of its output.  The query path and local sources are
+    left as rendering the query would leave them, so the directives after
+    it see the same state as in document order; a query holding further
+    queries, whose paths would decide that state, is rendered at once.
+
+    \param node The xdra:query element
+    \return the slot string, or None if the query must be rendered now
+    """
+    if self.deferred is None or self.getnodes: return None
+    if not self.independent(node): return None
+    if [1 for child in node.getiterator(self.queryTAG) if child is not node]:
+      return None
+    self.deferred.append((node,self.snapshot(),self.level))
+    self.querypath=self.queryPath(node)
+    self.localsources=[]
+    return "%s%d%s"%(self.slotmark,len(self.deferred)-1,self.slotmark)
+
+  def renderDeferred(self,output):
+    """\brief Renders the deferred queries and puts them into \em output
+
+    While \em parseModel() walks a model, independent top-level queries
+    (see \em independent()) are not rendered but leave a numbered slot in
+    the output and a snapshot of the sources they may read.  Slot numbers
+    are bracketed by \a slotmark, a token made afresh for every run, so
+    no output of the model itself is taken for a slot.  Once the walk
+    is done the queries are rendered on forked parser contexts, in
+    parallel according to \a parallelQueries ("threads", "processes",
+    "off", or "auto", which uses processes once there are several queries
+    and the sources hold more than \a parallelThreshold elements), and
+    the outputs are put into their slots in document order.  The auto
+    estimate comes from the load statistics, see \em sourceElements(), so
+    no source is walked (or a lazy one read in full) to decide.  Process
+    workers are forked with the
+    contexts of this call only, so parsers on other threads can render
+    their own deferred queries at the same time.  The slots are filled
+    piece by piece as \em output is read back, into a buffer that is in a
+    temporary file when \em output is, so a spilled output is never held
+    in memory whole.
+
+    \param output The memory.OutputBuffer of the model holding the slots
+    \return a memory.OutputBuffer with every slot filled, \em output
+    itself when there are no deferred queries
+    """
+    deferred=self.deferred
+    self.deferred=None
+    if not deferred: return output
+    mode=self.parallelQueries
+    if len(deferred)<2 or self.workers<2: mode="off"
+    elif mode=="auto":
+      mode="off"
+      if _canFork() and self.sourceElements()>self.parallelThreshold:
+        mode="processes"
+    contexts=[]
+    for node, snapshot, level in deferred:
+      parser=self.fork(snapshot)
+      parser.level=level
+      contexts.append((parser,node))
+    if hooks.enabled: hooks.emit("queries.deferred",queries=len(contexts),mode=mode)
+    if mode=="threads":
+      results=self._threadPool("queries").map(_renderQuery,contexts)
+    elif mode=="processes":
+      import multiprocessing
+      pool=multiprocessing.Pool(min(self.workers,len(contexts)),
+          _initDeferred,(contexts,))
+      try:
+        results=pool.map(_renderDeferred,range(len(contexts)))
+      finally:
+        pool.terminate()
+    else:
+      results=map(_renderQuery,contexts)
+    filled=memory.OutputBuffer()
+    if output.spilled(): filled.spill()
+    for data in _fillSlots(output.chunks(),self.slotmark,results):
+      filled.append(data)
+    return filled
+
+  def sourceElements(self):
+    """\brief Returns the number of elements the run's sources were loaded with
+
+    The count comes from \a sourceStats, so it costs no walk over the
+    trees; lazy sources, whose rows are not known until they are read,
+    count as none.
+
+    \return the number of elements
+    """
+    total=0
+    for stats in self.sourceStats:
+      total+=stats["elements"] or 0
+    return total
+
+  def _threadPool(self,name):
+    """\brief Returns the thread pool \em name, starting it the first time
+
+    \param name "threads" for source fan-out, "queries" for deferred queries
+    \return a multiprocessing.pool.ThreadPool of \a workers threads
+    """
+    self.poolLock.acquire()
+    try:
+      pool=self.pools.get(name)
+      if pool is None:
+        from multiprocessing.pool import ThreadPool
+        pool=self.pools[name]=ThreadPool(self.workers)
+      return pool
+    finally:
+      self.poolLock.release()
+
+  def closePools(self):
+    """\brief Terminates the thread and process pools of this parser
+
+    Pools live for one model run at most: \em parseModel() closes them
+    when the outermost model is done, as does \em reset(), so forked
+    workers never outlive the trees they were forked with and no
+    processes are left behind in watch or batch mode.  Forks and child
+    contexts share the pools, so they are cleared in place.
+    """
+    self.poolLock.acquire()
+    try:
+      for entry in self.pools.values():
+        if isinstance(entry,tuple): entry=entry[-1]
+        entry.terminate()
+        entry.join()
+      self.pools.clear()
+    finally:
+      self.poolLock.release()
+
+  def _forkPool(self,sources):
+    """\brief Returns a process pool whose workers hold \em sources
+
+    A new pool is forked whenever the list of sources or the source
+    \a version differs from those the current pool was forked with, and
+    pools are closed at the end of every run, so workers never match
+    against trees changed since they forked.  The sources are handed to
+    the workers as they fork, so nothing of this parser is kept in module
+    globals of the parent process.  The caller holds \a poolLock.
+    """
+    if self.pools.has_key("processes"):
+      version, forked, pool = self.pools["processes"]
+      if version==self.version and len(forked)==len(sources) and not [1
+          for a, b in zip(forked,sources) if a is not b]:
+        return pool
+      pool.terminate()
+      pool.join()
+    import multiprocessing
+    pool=multiprocessing.Pool(self.workers,_initShared,(list(sources),))
+    self.pools["processes"]=(self.version,list(sources),pool)
+    return pool
+
+  def fieldPaths(self,node):
+    """\brief Finds the getcontent fields an xdra:getnode body can extract
+
+    All xdra:getcontent elements below \em node, but not below a nested
+    xdra:getnode or xdra:model, are collected when their path names a
+    single child tag (such as ./title).  These fields can be pulled out of
+    an item in one pass over its children, see \em recordFields().
+
+    \param node The current xdra:getnode element
+    \return a dictionary mapping child tags to the list of paths naming them
+    """
+    fields={}
+    stack=list(node.getchildren())
+    while stack:
+      child=stack.pop()
+      if child.tag == self.getcontentTAG:
+        path=child.attrib.get("path")
+        if not path: continue
+        try:
+          tag=elementpath.compile(path).tag
+        except SyntaxError:
+          continue
+        if tag is None: continue
+        paths=fields.setdefault(tag,[])
+        if path not in paths: paths.append(path)
+      elif child.tag not in (self.getnodeTAG,self.modelTAG):
+        stack.extend(child.getchildren())
+    return fields
+
+  def recordFields(self,item,fields):
+    """\brief Extracts every field of \em item in one pass over its children
+
+    The text of the first child having each tag in \em fields is stored
+    under every path naming that tag, giving the same result as calling
+    findtext() once per path while scanning the children only once.
+
+    \param item The current getnode source item
+    \param fields A dictionary as returned by \em fieldPaths()
+    \return a dictionary mapping getcontent paths to text (or None)
+    """
+    record={}
+    for paths in fields.values():
+      for path in paths: record[path]=None
+    remaining=len(fields)
+    seen={}
+    for child in item.getchildren():
+      tag=child.tag
+      if fields.has_key(tag) and not seen.has_key(tag):
+        seen[tag]=1
+        for path in fields[tag]: record[path]=child.text
+        remaining-=1
+        if not remaining: break
+    return record
+
   def parseLiteral(self,node):
     """\brief Parses an xdra:literal for its contents into the output
 
@@ -211,9 +600,15 @@ class ModelParser:
     and sets the local context for the getnode operation and child
     getcontent directives.  File and URL sources are all-inclusive.  The i
     results to query/getnode path pair are appended to a large list of
-    "matched nodes" which is then iterated over according to the processing
+    "matched nodes" (at most \a limit of them, if the getnode has that
+    attribute) which is then iterated over according to the processing
     instructions contained with the xdra:getnode element, or echoed verbatim
-    to the output where xdra:getnode has no child elements.
+    to the output where xdra:getnode has no child elements.  The simple
+    getcontent fields of the body are extracted from each item in a single
+    pass into \a record before the body is rendered for that item.  Items
+    repeated across sources are dropped as they are matched when the
+    getnode has a \a distinct attribute: the path of a key node, or "." to
+    compare whole items.
 
     \param node the current xdra:getnode element
     \return a string containing the output of this node and any child nodes
@@ -222,53 +617,91 @@ class ModelParser:
     datalist = []
     itemlist=[]
     if not path:
-      if _debug: print "No path in parseGetNode, setting path to ",self.querypath
       path=self.querypath
-    for source in self.globalsources:
-      if _debug: print "parseGetNode checking path",path,"in source",source
-      itemlist.extend(source.findall(path))
-    if _debug: print "parseGetNode itemlist:",itemlist
+    limit=node.attrib.get("limit")
+    if limit: limit=int(limit)
+    else: limit=None
+    distinct=node.attrib.get("distinct")
+    sources=self.globalsources
+    if self.atype=="join": #the joined source is the build side only
+      joined=self.findSource(self.joinspec[0])
+      sources=[source for source in sources if source is not joined]
+    if self.spill and self.atype in ("sort","reversesort") and self.skey:
+      itemlist=self.iterMatches(path,sources)
+      if distinct: itemlist=self.distinctItems(itemlist,distinct)
+    elif self.atype: #actions see every item, the limit applies to their result
+      itemlist=self.findMatches(path,sources,node.attrib.get("parallel"),
+          None,distinct)
+    else:
+      itemlist=self.findMatches(path,sources,node.attrib.get("parallel"),
+          limit,distinct)
+    if hooks.enabled: hooks.emit("getnode",path=path,action=self.atype,limit=limit,
+        distinct=distinct,items=isinstance(itemlist,list) and len(itemlist) or None)
 
     if self.atype:
       if self.atype.endswith("sort"):
         if self.skey:
-          if self.atype=="reversesort":
-            if _debug: print "parseGetNode: calling sort reversesort",itemlist
-            self.sort.sort(itemlist,self.skey,reverse=True)
+          if self.spill and self.atype in ("sort","reversesort"):
+            if hooks.enabled: hooks.emit("action.sort",key=self.skey,type=self.atype,spill=self.spill)
+            itemlist=self.sort.spill(itemlist,self.skey,self.atype=="reversesort",
+                self.keytype,self.spill)
+          elif self.atype=="reversesort":
+            if hooks.enabled: hooks.emit("action.sort",key=self.skey,type=self.atype,spill=None)
+            self.sort.sort(itemlist,self.skey,True,self.keytype)
           elif self.atype=="sort":
-            if _debug: print "parseGetNode: calling sort",itemlist
-            self.sort.sort(itemlist,self.skey,reverse=False)
+            if hooks.enabled: hooks.emit("action.sort",key=self.skey,type=self.atype,spill=None)
+            self.sort.sort(itemlist,self.skey,False,self.keytype)
           else:
-            if _debug: print "parseGetNode: invalid sort type ",atype
+            if hooks.enabled: hooks.emit("action.invalid",type=self.atype)
+        else:
+          if hooks.enabled: hooks.emit("action.nokey",type=self.atype)
+      elif self.atype in aggregate.TYPES:
+        if hooks.enabled: hooks.emit("action.aggregate",type=self.atype,key=self.skey)
+        itemlist=self.aggregate.apply(self.atype,itemlist,self.skey,
+            self.keytype,self.svalue)
+      elif self.atype=="join":
+        sname, jpath, jkey, jmatch, outer = self.joinspec
+        source=self.findSource(sname)
+        if source is None or not jkey:
+          if hooks.enabled: hooks.emit("action.nokey",type=self.atype,source=sname)
+          if not outer: itemlist=[]
         else:
-          if _debug: print "parseGetNode: missing key for sort"
+          if hooks.enabled: hooks.emit("action.join",source=sname,key=jkey,match=jmatch)
+          itemlist=self.join.join(itemlist,source,jpath or "./*",jkey,jmatch,outer)
       elif self.atype=="custom":
-        xdra_root=ElementTree.Element("root")
-        for item in itemlist:
-          xdra_root.append(item)
+        xdra_root=cow.ItemView(itemlist) #changes never reach the sources
         self.runner.setTree(xdra_root)
         datalist.append(self.runner.runAction()) #itemlist is now updated
-        itemlist=[item for item in xdra_root.getchildren()]
+        self.sort.invalidate() #the action may have changed any item
+        self.join.invalidate()
+        itemlist=xdra_root.results()
+    if limit is not None: itemlist=itertools.islice(itemlist,limit)
     if node.getchildren():
-      for item in itemlist:
-        for child in node.getchildren():
-          if child.tag == self.getcontentTAG:
-            if _debug: print "parseGetNode: calling parseGetContent for "+child.tag
-            if item:
-              data=self.parseGetContent(child, item)
-              if data: datalist.append(data)
-          elif child.tag == self.literalTAG:
-            if _debug: print "parseGetNode: calling parseLiteral for "+child.tag
-            if item:
-              data=self.parseLiteral(child)
-              if data: datalist.append(data)
-          else:
-            if _debug: print "parseGetNode: calling parseXML for "+child.tag
-            if item:
-              self.level+=1
-              data=self.parseXML(child, item)
-              self.level-=1
-              if data: datalist.append(data)
+      fields=self.fieldPaths(node)
+      outer=self.record
+      self.getnodes+=1
+      try:
+        for item in itemlist:
+          if fields and item:
+            self.record=(item,self.recordFields(item,fields))
+          for child in node.getchildren():
+            if child.tag == self.getcontentTAG:
+              if item:
+                data=self.parseGetContent(child, item)
+                if data: datalist.append(data)
+            elif child.tag == self.literalTAG:
+              if item:
+                data=self.parseLiteral(child)
+                if data: datalist.append(data)
+            else:
+              if item:
+                self.level+=1
+                data=self.parseXML(child, item)
+                self.level-=1
+                if data: datalist.append(data)
+      finally:
+        self.getnodes-=1
+        self.record=outer
     else:
       for item in itemlist:
         if item: datalist.append(ElementTree.tostring(item))
@@ -287,7 +720,25 @@ class ModelParser:
     items are available.  If the source type is detected to be "custom",
     then a model-level instance of the \em executor class is set up with
     the source code (the text element of a custom action) so that it may
-    be executed in place when the result tree is available from the sources.
+    be executed in place when the result tree is available from the
+    sources.  The script's xdra_tree is a cow.ItemView over the matched
+    items, so the changes it makes are seen by this getnode only and the
+    source trees stay as they were loaded for later queries.
+
+    Sort actions compare the text of their \a key lowercased, unless the
+    \a keytype attribute asks for "exact" text or "number" values.  A sort
+    with a \a spill attribute ("yes", or the number of items per run) is
+    done as an external merge sort through temporary files, and its items
+    are streamed into the getnode body; see sort.Sort.spill().
+
+    The group, count, sum and distinct types replace the matched items
+    with one item per distinct \a key, see aggregate.Aggregate; a sum
+    action adds up the node named by its \a value attribute.  A join
+    action pairs every item with the items of the source named by its
+    \a source attribute (those matching its \a path, or all children of
+    the source) whose \a key node has the text of the item's \a match
+    node, see join.Join; the items are matched in every source except the
+    joined one.
 
     \param node The current xdra:action element
     \return a string containing the output of this node and any child nodes
@@ -296,25 +747,36 @@ class ModelParser:
     childlist=node._children
     self.atype=node.attrib.get("type")
     self.skey=node.attrib.get("key")
-    if _debug: print "parseAction: action type is ",self.atype
+    self.keytype=node.attrib.get("keytype","text")
+    self.svalue=node.attrib.get("value")
+    if self.atype=="join":
+      self.joinspec=(node.attrib.get("source"),node.attrib.get("path"),
+          self.skey,node.attrib.get("match"),node.attrib.get("outer") in ("1","yes"))
+    self.spill=node.attrib.get("spill")
+    if self.spill in ("1","yes"): self.spill=self.spillRunSize
+    elif self.spill and self.spill.isdigit(): self.spill=int(self.spill)
+    elif self.streaming: self.spill=self.spillRunSize
+    else: self.spill=None
+    if hooks.enabled: hooks.emit("action",type=self.atype,key=self.skey)
     if self.atype=="custom":
       self.runner.setName(node.attrib.get("name"))
       self.runner.setCode(node.text)
     for child in childlist:
       if child.tag==self.getnodeTAG:
-        if _debug: print "parseAction: calling parseGetNode for "+child.tag
         data=self.parseGetNode(child)
         if data: datalist.append(data)
       elif child.tag == self.literalTAG:
-        if _debug: print "parseModel: calling parseLiteral for "+child.tag
         data=self.parseLiteral(child)
         if data: datalist.append(data)
       else:
-        if _debug: print "parseAction: calling parseXML for "+child.tag
         data=self.parseXML(child)
         if data: datalist.append(data)
     self.atype=""
     self.skey=""
+    self.keytype="text"
+    self.spill=None
+    self.svalue=""
+    self.joinspec=None
     if datalist:
       data="".join(datalist)
       return data
@@ -334,31 +796,21 @@ class ModelParser:
     \param node the current xdra:query element
     \return a string containing the output of this node and any child nodes
     """
-    self.querypath=node.attrib.get("path")
-    if self.querypath:
-      if self.querypath.endswith("/"):
-        self.querypath = self.querypath[:-1]
-    else:
-      if _debug: print "parseQuery: no path in query!"
-
+    self.querypath=self.queryPath(node)
     self.localsources=[]
     datalist=[]
     qtype=node.attrib.get("type")
-    if _debug: print "parseQuery: setting global path to ",self.querypath
+    if hooks.enabled: hooks.emit("query",path=self.querypath,level=self.level)
     for child in node.getchildren():
       if child.tag==self.actionTAG:
-        if _debug: print "parseQuery: calling parseAction for "+child.tag
         data=self.parseAction(child)
         if data: datalist.append(data)
       elif child.tag==self.sourceTAG:
-        if _debug: print "parseQuery: calling parseSource for "+child.tag
         localsources.append(self.parseSource(child, local=True))
       elif child.tag == self.literalTAG:
-        if _debug: print "parseModel: calling parseLiteral for "+child.tag
         data=self.parseLiteral(child)
         if data: datalist.append(data)
       else:
-        if _debug: print "parseQuery: calling parseXML for "+child.tag
         self.level+=1
         data=self.parseXML(child)
         self.level-=1
@@ -369,61 +821,606 @@ class ModelParser:
     else:
       return None
 
+  def queryPath(self,node):
+    """\brief Returns the path the xdra:query \em node sets for its getnodes
+
+    \param node the xdra:query element
+    \return the path attribute without a trailing slash, or None
+    """
+    path=node.attrib.get("path")
+    if path and path.endswith("/"): path=path[:-1]
+    return path
+
+  def project(self,doc):
+    """\brief Works out which parts of its sources the model \em doc can read
+
+    Every xdra:query and xdra:getnode of the model (outside included
+    models) is analysed: every tag along its path is kept as an item, the
+    children named in the predicates of its path and the first tag of each
+    getcontent path in its body are fields read from items, and sort keys
+    name tags searched for anywhere below an item.  The result is a
+    conglomerator.Projection that lets file and url sources skip building
+    everything else.  No projection is possible when the model could read
+    arbitrary parts of an item: a getnode without a body (the whole item
+    is output), custom or other non-sort actions, or wildcard steps, or
+    descendant steps where fields are taken.  The model can also opt out
+    with project="no".
+
+    \param doc an XML object where xdra:model is the root node
+    \return a conglomerator.Projection, or None if none is possible
+    """
+    if doc.attrib.get("project") in ("0","no"): return None
+    items={}
+    fields={}
+    descendants={}
+    try:
+      self._project(doc,self.querypath,items,fields,descendants)
+    except (SyntaxError, ValueError):
+      return None
+    if not items: return None
+    return conglomerator.Projection(items.keys(),fields.keys(),descendants.keys())
+
+  def _project(self,node,querypath,items,fields,descendants):
+    """\brief Collects the projection of the children of \em node
+
+    \exception ValueError if the model cannot be projected
+    """
+    for child in node.getchildren():
+      if child.tag == self.modelTAG:
+        continue
+      elif child.tag == self.queryTAG:
+        path=child.attrib.get("path")
+        if path and path.endswith("/"): path=path[:-1]
+        if path: self._projectPath(path,items,fields)
+        self._project(child,path,items,fields,descendants)
+      elif child.tag == self.actionTAG:
+        atype=child.attrib.get("type")
+        if atype in ("sort","reversesort"):
+          if child.attrib.get("key"): descendants[child.attrib.get("key")]=1
+        elif atype:
+          raise ValueError("cannot project %s actions"%atype)
+        self._project(child,querypath,items,fields,descendants)
+      elif child.tag == self.getnodeTAG:
+        path=child.attrib.get("path") or querypath
+        if not (path and child.getchildren()):
+          raise ValueError("getnode outputs whole items")
+        self._projectPath(path,items,fields)
+        distinct=child.attrib.get("distinct")
+        if distinct:
+          compiled=elementpath.compile(distinct)
+          step=compiled.steps and compiled.steps[0]
+          if not step or step.tag=="*":
+            raise ValueError("cannot project distinct path %s"%distinct)
+          if step.axis=="child": fields[step.tag]=1
+          else: descendants[step.tag]=1
+        stack=list(child.getchildren())
+        while stack:
+          body=stack.pop()
+          if body.tag == self.getcontentTAG:
+            if not body.attrib.get("path"): continue
+            compiled=elementpath.compile(body.attrib.get("path"))
+            step=compiled.steps and compiled.steps[0]
+            if not step or step.axis!="child" or step.tag=="*":
+              raise ValueError("cannot project getcontent path")
+            fields[step.tag]=1
+          elif body.tag in (self.getnodeTAG,self.queryTAG,self.actionTAG,self.sourceTAG):
+            wrapper=ElementTree.Element("body")
+            wrapper.append(body)
+            self._project(wrapper,querypath,items,fields,descendants)
+          elif body.tag != self.modelTAG:
+            stack.extend(body.getchildren())
+      elif child.tag != self.sourceTAG:
+        self._project(child,querypath,items,fields,descendants)
+
+  def _projectPath(self,path,items,fields):
+    """\brief Adds the tags along \em path and its predicates to a projection
+
+    \exception ValueError if the path has a wildcard step
+    """
+    for step in elementpath.compile(path).steps:
+      if step.tag=="*":
+        raise ValueError("cannot project path %s"%path)
+      items[step.tag]=1
+      for predicate in step.predicates:
+        if predicate[0]=="child": fields[predicate[1]]=1
+
+  def sourceProjection(self,node):
+    """\brief Returns the projection to load the xdra:source \em node with
+
+    Sources are projected when \a projectSources is set, or when the
+    memory budget switched the run to \a streaming, unless they opt out.
+    A shared conglomerator loads whole sources until the run is streaming,
+    so models reading different parts of the same declaration still share
+    one parse of it.
+
+    \param node the current xdra:source element
+    \return the model's projection, or None if the source is loaded whole
+    """
+    if node.attrib.get("project") in ("0","no"): return None
+    if self.streaming: return self.projection
+    if not self.projectSources or self.conglomerator.shared: return None
+    return self.projection
+
   def parseSource(self,node,local=False):
     """\brief Parses an xdra:source declaration and stores for future use
 
     \em parseSource() handles the declaration of valid xdra:source
     elements including file sources (from directories containing XML files)
-    and URL sources When declaring file sources, there is an attribute to
+    and URL sources.  When declaring file sources, there is an attribute to
     process the path directory recursively.  When declaring URL sources, the
-    URL must be valid.  When a valid source is encountered it is added to the
-    class level source list to be processed in response to query/getnode pairs.
+    URL must be valid.
+
+    Table sources (csv, tsv and jsonl) name a single file whose records
+    become elements tagged by the \a row attribute (default "row"), with
+    one child per field; \a fields lists the field names and
+    \a header="no" says a delimited file has no header line.
+
+    When a valid source is encountered it is added to the class level
+    source list to be processed in response to query/getnode pairs.
 
     \param node the current xdra:source element
     \param local defines if the source is local to the current query or not
     """
     stype=node.attrib.get("type")
+    self.conglomerator.caching=not self.streaming
     if stype=="files":
       path = node.attrib.get("path")
       rootname = node.attrib.get("name")
       if not (path and rootname):
-        if _debug: print "parseSource: no path or rootname found"
+        if hooks.enabled: hooks.emit("source.invalid",type=stype,name=rootname,path=path)
       else:
         if node.attrib.get("recursive") in ("1","yes"):
-          source=self.conglomerator.getDocObj(path,rootname,recursive=True)
+          source=self.conglomerator.getDocObj(path,rootname,recursive=True,
+              projection=self.sourceProjection(node))
+          self.dependencies.append((path,True))
         else:
-          source=self.conglomerator.getDocObj(path,rootname,recursive=False)
+          source=self.conglomerator.getDocObj(path,rootname,recursive=False,
+              projection=self.sourceProjection(node))
+          self.dependencies.append((path,False))
         if not local:
           if source: self.globalsources.append(source)
         else:
           if source: self.localsources.append(source)
-        if _debug:
-          print "parseSource: new source list: ",self.globalsources,self.localsources
+        self.addSourceStats(self.conglomerator.stats,local)
+        if hooks.enabled: hooks.emit("source",type=stype,name=rootname,path=path,
+            local=local,tree=lambda: ElementTree.tostring(source))
     elif stype=="custom":
       sname=node.attrib.get("name")
-      if _debug: print "parseSource: processing custom source",sname
       self.runner.setName(sname)
       self.runner.setCode(node.text)
       sroot=ElementTree.Element(sname)
       self.runner.setTree(sroot)
+      self.runner.projection=self.sourceProjection(node)
+      stats=conglomerator.newStats(stype,sname,None)
+      start=time.time()
       sroot=self.runner.runSource() #get xdra_tree
+      stats["parse"]=time.time()-start
+      if self.runner.rows is not None: #rows are produced as they are matched
+        fields=node.attrib.get("fields")
+        if fields: fields=[field.strip() for field in fields.split(",")]
+        sroot=lazysource.LazySource(sname,self.runner.rows,
+            node.attrib.get("row","row"),fields,self.runner.projection)
+        self.runner.rows=None
+        stats["elements"]=None #not known until the rows are read
+      else:
+        stats["elements"], stats["attributes"] = conglomerator.countTree(sroot)
+        stats["peak"]=stats["elements"]
       self.globalsources.append(sroot) #add the new source tree
-      if _debug: print "parseSource: new source list: ",self.globalsources,self.localsources
+      self.addSourceStats(stats,False)
+      if hooks.enabled: hooks.emit("source",type=stype,name=sname,path=None,
+          local=False,tree=lambda: ElementTree.tostring(sroot))
     elif stype=="url":
       rootname=node.attrib.get("name")
       path=node.attrib.get("path")
-      source=self.conglomerator.getDocObj(path,rootname,url=True)
+      source=self.conglomerator.getDocObj(path,rootname,url=True,
+          projection=self.sourceProjection(node))
       if not local:
         if source: self.globalsources.append(source)
       else:
         if source: self.localsources.append(source)
-      if _debug:
-        print "parseSource: from url ",path,"\n",ElementTree.tostring(source)
-        print "parseSource: new source list: ",self.globalsources,self.localsources
+      self.addSourceStats(self.conglomerator.stats,local)
+      if hooks.enabled: hooks.emit("source",type=stype,name=rootname,path=path,
+          local=local,tree=lambda: ElementTree.tostring(source))
+    elif stype in ("csv","tsv","jsonl"):
+      path=node.attrib.get("path")
+      rootname=node.attrib.get("name")
+      if not (path and rootname):
+        if hooks.enabled: hooks.emit("source.invalid",type=stype,name=rootname,path=path)
+        return
+      fields=node.attrib.get("fields")
+      if fields: fields=[field.strip() for field in fields.split(",")]
+      source=self.conglomerator.getTableObj(path,rootname,stype,
+          node.attrib.get("row","row"),node.attrib.get("header","yes") in ("1","yes"),
+          fields,self.sourceProjection(node))
+      self.dependencies.append((path,False))
+      if not local:
+        self.globalsources.append(source)
+      else:
+        self.localsources.append(source)
+      self.addSourceStats(self.conglomerator.stats,local)
+      if hooks.enabled: hooks.emit("source",type=stype,name=rootname,path=path,
+          local=local,rows=len(source))
     else:
-      if _debug: print "parseSource: Undefined source type ",stype
+      if hooks.enabled: hooks.emit("source.invalid",type=stype,
+          name=node.attrib.get("name"),path=node.attrib.get("path"))
+    self.version+=1
+    self.checkMemory()
+
+  def addSourceStats(self,stats,local=False):
+    """\brief Records the load statistics of a declared source
+
+    After a model has run, \a sourceStats holds one record per source
+    declaration, including those of included models, in the order they
+    were loaded; see conglomerator.newStats() for the fields.  Sources
+    declared inside a getnode loop are recorded every time they are
+    declared.
+
+    \param stats The record to keep, as left in conglomerator.FileInput.stats
+    \param local (False) Whether the source is local to a query
+    """
+    if stats is None: return
+    stats=dict(stats)
+    stats["local"]=local
+    self.sourceStats.append(stats)
+    if hooks.enabled: hooks.emit("source.stats",name=stats["name"],
+        bytes=stats["bytes"],elements=stats["elements"],
+        fetch=stats["fetch"],parse=stats["parse"])
+
+  def memoryUsage(self):
+    """\brief Estimates the memory held by the current model run
 
-  def parseModel(self,doc):
+    The estimate has three parts: the source trees loaded by the run
+    (from \a sourceStats), the caches (parsed files the run is not using,
+    sort key columns, join indexes, document orders and in-memory
+    outputs), and the model output collected in memory so far.  Tree
+    sizes are estimated from their element and attribute counts, see
+    memory.treeBytes().  A tree is counted once however many declarations
+    load it: files are counted by name, and a shared document only when
+    its first declaration is not part of the run.  The run of an included
+    model counts the sources, document orders and output of the models
+    including it as well, see \em contexts().
+
+    \return a dictionary with the keys sources, caches and output
+    """
+    contexts=self.contexts()
+    sources=0
+    names={}
+    documents={}
+    for stats in self.contextStats():
+      document=(stats["type"],stats["name"],stats["path"])
+      if stats["shared"]:
+        if not documents.has_key(document): sources+=memory.statsBytes(stats)
+      elif stats["files"]:
+        for entry in stats["files"]:
+          if names.has_key(entry["name"]): continue
+          names[entry["name"]]=1
+          sources+=memory.treeBytes(entry["bytes"],entry["elements"],
+              entry["attributes"])
+      else:
+        sources+=memory.statsBytes(stats)
+      documents[document]=1
+    caches=0
+    fileinput=self.conglomerator
+    for key, entry in fileinput.treecache.items():
+      if isinstance(key,tuple): key=key[key[0]=="table" and 1 or 0]
+      if not names.has_key(key): caches+=memory.treeBytes(*entry[2])
+    entries=0
+    for column in self.sort.columns.values(): entries+=len(column)
+    for source, table in self.join.indexes.values():
+      for members in table.values(): entries+=len(members)
+    for parser in contexts:
+      for source, elements in parser.orders.values(): entries+=len(elements)
+    caches+=entries*memory.ENTRY
+    for item in self.outputs.cache.values():
+      if isinstance(item,tuple): item=item[0]
+      if isinstance(item,basestring): caches+=len(item)
+    output=0
+    for parser in contexts:
+      if parser.output is not None: output+=parser.output.resident()
+    return {"sources":sources, "caches":caches, "output":output}
+
+  def contexts(self):
+    """\brief Returns this context followed by the contexts including it
+
+    \return a list of ModelParser contexts, the outermost model last
+    """
+    contexts=[]
+    parser=self
+    while parser is not None:
+      contexts.append(parser)
+      parser=parser.parent
+    return contexts
+
+  def contextStats(self):
+    """\brief Returns the source statistics of this and the including runs
+
+    \return a list of records, those of the outermost model first
+    """
+    records=[]
+    for parser in self.contexts():
+      records[:0]=parser.sourceStats
+    return records
+
+  def memoryReport(self):
+    """\brief Describes the memory use of the current model run
+
+    \return a dictionary with the \a budget, the estimated \a usage by
+    category and its \a total, the \a reactions taken so far, and the
+    five largest \a sources with their estimated size
+    """
+    usage=self.memoryUsage()
+    sources=[]
+    for stats in self.contextStats():
+      sources.append({"name":stats["name"], "type":stats["type"],
+          "path":stats["path"], "estimate":memory.statsBytes(stats)})
+    sources.sort(key=lambda source: source["estimate"], reverse=True)
+    return {"budget":self.memoryBudget, "usage":usage,
+        "total":sum(usage.values()), "reactions":list(self.reactions),
+        "sources":sources[:5]}
+
+  def evictCaches(self):
+    """\brief Drops every cache that can be rebuilt
+
+    Parsed files and shared documents, sort key columns, join indexes,
+    document orders, in-memory outputs and parsed models are dropped.
+    Trees still used as sources stay loaded; only the cache entries for
+    them go.  The dictionaries are cleared in place, so forked contexts
+    sharing them let go of the entries too.
+    """
+    fileinput=self.conglomerator
+    for table in (fileinput.treecache,fileinput.doccache,self.outputs.cache,
+        self.models):
+      table.clear()
+    self.sort.invalidate()
+    self.join.invalidate()
+    for parser in self.contexts():
+      parser.orders={}
+
+  def checkMemory(self):
+    """\brief Keeps the model run within \a memoryBudget
+
+    Does nothing unless \a memoryBudget is set.  When the estimate of
+    \em memoryUsage() is over the budget, the parser reacts in turn: the
+    output collected so far is moved to a temporary file, the caches are
+    evicted with \em evictCaches(), and the rest of the run is switched
+    to \a streaming: sources declared from then on are loaded with the
+    model's projection, even by a shared conglomerator, the files and
+    documents they are built from are no longer kept in the caches (see
+    conglomerator.FileInput.caching), so local sources are freed after
+    their query, and sorts spill to disk.  Streaming cannot shrink sources
+    already loaded, so only when the run is still over budget at a later
+    check, with every reaction already taken, is the run stopped.
+
+    \exception memory.MemoryBudgetError with the \em memoryReport()
+    """
+    if not self.memoryBudget: return
+    total=sum(self.memoryUsage().values())
+    if total<=self.memoryBudget: return
+    if hooks.enabled: hooks.emit("memory.pressure",total=total,
+        budget=self.memoryBudget,report=self.memoryReport)
+    streaming=self.streaming
+    for parser in self.contexts():
+      if parser.output is not None and parser.output.resident():
+        parser.output.spill()
+        if "spill output" not in self.reactions: self.reactions.append("spill output")
+    self.evictCaches()
+    if "evict caches" not in self.reactions: self.reactions.append("evict caches")
+    if not streaming:
+      self.streaming=True
+      self.reactions.append("stream sources")
+    report=self.memoryReport()
+    if report["total"]<=self.memoryBudget or not streaming: return
+    usage=report["usage"]
+    message="memory budget of %s exceeded, about %s in use (sources %s, caches %s, output %s)"%(
+        memory.formatSize(self.memoryBudget),memory.formatSize(report["total"]),
+        memory.formatSize(usage["sources"]),memory.formatSize(usage["caches"]),
+        memory.formatSize(usage["output"]))
+    if report["sources"]:
+      largest=report["sources"][0]
+      message+="; largest source %s (%s) is about %s"%(largest["name"],
+          largest["path"],memory.formatSize(largest["estimate"]))
+    if hooks.enabled: hooks.emit("memory.exceeded",report=report)
+    raise memory.MemoryBudgetError(message,report)
+
+  def snapshot(self):
+    """\brief Returns a consistent snapshot of the declared sources
+
+    The source set only ever grows by new declarations, each of which
+    bumps \a version, and the source trees themselves are never changed
+    while a model runs (custom actions work on cow.ItemView copies).  A
+    snapshot is therefore the version together with the sources declared
+    so far, and reading it gives the same results however many sources are
+    declared afterwards.
+
+    \return a (version, sources) pair, where sources is a tuple
+    """
+    return (self.version,tuple(self.globalsources))
+
+  def fork(self,snapshot=None):
+    """\brief Returns a parser context that evaluates against \em snapshot
+
+    The fork has its own query state, executor and file input, so it can
+    evaluate queries at the same time as this parser and other forks, on
+    another thread.  It shares this parser's code, file, key and output
+    caches.  Sources it declares and the files it reads are its own; they
+    are found in its \a globalsources and \a dependencies afterwards.
+
+    \param snapshot (None) A snapshot from \em snapshot(), or the current
+    sources when None
+    \return a new ModelParser context
+    """
+    version, sources = snapshot or self.snapshot()
+    parser=copy.copy(self)
+    parser.runner=self.runner.fork()
+    parser.conglomerator=self.conglomerator.fork()
+    parser.reset(keepsources=True)
+    parser.globalsources=list(sources)
+    parser.localsources=[]
+    parser.dependencies=[]
+    parser.version=version
+    parser.projection=self.projection
+    if self.profiler: self.profiler.instrument(parser)
+    return parser
+
+  def fingerprint(self,doc):
+    """\brief Computes a key identifying the output of the model \em doc
+
+    The key is an md5 checksum of the serialized model combined with a
+    version for every source the model declares: the names, times and
+    sizes of the files of files sources, the HTTP validators of url
+    sources, the name, time and size of table files (or the validators of
+    tables read from a URL), and the code of custom sources.  Included
+    models given by path are fingerprinted in turn.  If any source cannot
+    be versioned (for example a url served without ETag or Last-Modified
+    headers, or a missing file), the output cannot be cached and \em None
+    is returned.
+
+    \param doc an XML object where xdra:model is the root node
+    \return an md5 checksum string, or None if the output is uncacheable
+    """
+    keylist=[ElementTree.tostring(doc)]
+    for node in doc.getiterator():
+      if node.tag == self.sourceTAG:
+        stype=node.attrib.get("type")
+        path=node.attrib.get("path")
+        if stype=="files":
+          if not path: continue
+          recursive=node.attrib.get("recursive") in ("1","yes")
+          version=self.conglomerator.getVersion(path,recursive=recursive)
+        elif stype=="url":
+          version=self.conglomerator.getVersion(path,url=True)
+        elif stype in ("csv","tsv","jsonl"):
+          if not path: continue
+          version=self.conglomerator.getVersion(path,url=not os.path.isfile(path))
+        elif stype=="custom":
+          version=self.runner.getkey(node.text or "")
+        else:
+          continue
+        if version is None: return None
+        keylist.append(repr(version))
+      elif node.tag == self.modelTAG and node is not doc:
+        path=node.attrib.get("path")
+        if not path: continue
+        try:
+          version=self.fingerprint(self.loadModel(path))
+        except:
+          return None
+        if version is None: return None
+        keylist.append(version)
+    return self.outputs.getkey("\n".join(keylist))
+
+  def precompile(self,doc):
+    """\brief Compiles every path used by the model \em doc ahead of time
+
+    The path attributes of xdra:query, xdra:getnode and xdra:getcontent
+    and the key path of sorting actions are compiled into the elementpath
+    cache, so that the paths are tokenized once per model rather than
+    while items are being matched.  Invalid paths are left to raise their
+    error where they are used.
+
+    \param doc an XML object where xdra:model is the root node
+    """
+    for node in doc.getiterator():
+      path=None
+      if node.tag in (self.queryTAG,self.getnodeTAG,self.getcontentTAG):
+        path=node.attrib.get("path")
+        if path and path.endswith("/"): path=path[:-1]
+      elif node.tag == self.actionTAG and node.attrib.get("key"):
+        path=".//"+node.attrib.get("key")
+      if path:
+        try:
+          elementpath.compile(path)
+        except SyntaxError:
+          if hooks.enabled: hooks.emit("path.invalid",path=path)
+
+  def child(self):
+    """\brief Returns a lightweight parser context for an included model
+
+    The child context shares this parser's conglomerator, sort, parsed
+    model cache and output cache, and gets a fork of its executor, so an
+    included model reuses the compiled code, parsed files and outputs of
+    its parent without touching the script its parent is about to run.
+    It starts with its own empty sources and query state just like a new
+    parser.
+    Output caching is always on for child contexts, see \em parseSubModel().
+
+    \return a new ModelParser sharing this parser's caches
+    """
+    parser=copy.copy(self)
+    parser.runner=self.runner.fork()
+    parser.parent=self
+    parser.reset()
+    parser.streaming=self.streaming
+    parser.cacheOutput=True
+    if self.profiler: self.profiler.instrument(parser)
+    return parser
+
+  def loadModel(self,path):
+    """\brief Returns the parsed model document at \em path
+
+    Parsed models are kept in \a models with the modification time and
+    size of their file and are only parsed again after the file changes,
+    so models included from inside a getnode loop are read once.
+
+    \param path The filename of the model document
+    \return the root element of the model document
+    """
+    st=os.stat(path)
+    stamp=(st.st_mtime,st.st_size)
+    cached=self.models.get(path)
+    if cached and cached[0]==stamp:
+      return cached[1]
+    doc=ElementTree.parse(path).getroot()
+    self.models[path]=(stamp,doc)
+    return doc
+
+  def parseSubModel(self,node):
+    """\brief Parses an included xdra:model and returns its output
+
+    An included model is either given by its \a path attribute or inline
+    as the children of the xdra:model element.  It is rendered on a
+    \em child() context, so its sources stay separate from the parent's
+    while the caches are shared, and its output is memoized under its
+    \em fingerprint(): as long as the included model and its sources are
+    unchanged, rendering it again (for instance once per getnode item)
+    returns the stored output.  The child run is held to the memory
+    budget together with this one, and the reactions it takes are taken
+    for this run too.  Invalid models are silently ignored, but a
+    memory.MemoryBudgetError of the child run stops this run as well.
+
+    \param node The current xdra:model element
+    \return a string containing the output of the included model
+    """
+    path=node.attrib.get("path")
+    try:
+      if path:
+        cmodel=self.loadModel(path)
+        if (path,False) not in self.dependencies:
+          self.dependencies.append((path,False))
+      elif node.getchildren():
+        cmodel=node
+      else:
+        if hooks.enabled: hooks.emit("submodel.invalid",path=None)
+        return None
+      if hooks.enabled: hooks.emit("submodel",path=path)
+      parser=self.child()
+      try:
+        data=parser.parseModel(cmodel)
+      finally:
+        for reaction in parser.reactions:
+          if reaction not in self.reactions: self.reactions.append(reaction)
+        if parser.streaming: self.streaming=True
+      for entry in parser.dependencies:
+        if entry not in self.dependencies: self.dependencies.append(entry)
+      self.sourceStats.extend(parser.sourceStats)
+      return data
+    except memory.MemoryBudgetError:
+      raise
+    except:
+      if hooks.enabled: hooks.emit("submodel.invalid",path=path)
+      return None
+
+  def parseModel(self,doc,stream=None):
     """\brief Parses an xdra:model set given as the root node of doc
 
     \em parseModel() is the central controlling method for obtaining the
@@ -435,72 +1432,423 @@ class ModelParser:
     arbitrary XML nodes and not as xdra directives.  The entire output of
     the model is aggregated and returned as a string.
 
+    When \a cacheOutput is set, the \em fingerprint() of the model is
+    looked up in \a outputs first, and on a hit the stored output is
+    returned (and written to the output file) without parsing any source.
+    A new output supersedes the one stored for an earlier version of the
+    model's sources, see cache.Cache.supersede().
+
+    Unless \a parallelQueries is "off", independent queries are rendered
+    after the rest of the model, possibly in parallel; see
+    \em renderDeferred().
+
+    The output file, and \em stream when given, are written piece by
+    piece, so an output the memory budget moved to a temporary file (see
+    \em checkMemory()) is never read back whole unless it is returned.
+    Such an output is not stored in \a outputs either.
+
     \param doc an XML object where xdra:model is the root node
-    \return a string containing the final output of the model
+    \param stream (None) A file-like object to write the output to instead
+    of returning it
+    \return a string containing the final output of the model, or None
+    when it was written to \em stream
     """
     if doc.tag != self.modelTAG: return None
-    output=[]
+    key=None
+    if self.cacheOutput:
+      key=self.fingerprint(doc)
+      if key and self.outputs.contains(key):
+        data, self.dependencies = self.outputs.retrieve(key)
+        if hooks.enabled: hooks.emit("model.cached",key=key)
+        file=doc.attrib.get("output")
+        if file:
+          fp=open(file,'w')
+          fp.write(data)
+          fp.close()
+        if stream is None: return data
+        stream.write(data)
+        return None
+    self.precompile(doc)
+    self.projection=self.project(doc)
+    if self.parallelQueries!="off":
+      self.deferred=[]
+      self.slotmark="\0xdra%s\0"%os.urandom(8).encode("hex")
+    output=self.output=memory.OutputBuffer()
     #if doc.text: output.append(doc.text)
     for child in doc.getchildren():
       if child.tag == self.sourceTAG:
-        if _debug: print "parseModel: calling parseSource for "+child.tag
         self.parseSource(child, local=False)
       elif child.tag == self.queryTAG:
-        if _debug: print "parseModel: calling parseQuery for "+child.tag
-        data=self.parseQuery(child)
+        data=self.deferQuery(child) or self.parseQuery(child)
         if data: output.append(data)
       elif child.tag == self.literalTAG:
-        if _debug: print "parseModel: calling parseLiteral for "+child.tag
         data=self.parseLiteral(child)
         if data: output.append(data)
       elif child.tag == self.modelTAG:
-        path=child.attrib.get("path")
-        if path:
-          try:
-            cmodel=ElementTree.parse(path).getroot()
-            if _debug: print "parseModel: calling parseModel for "+child.tag
-            #new instance just in case
-            parser=ModelParser(self.globalsources,self.localsources)
-            data=parser.parseModel(cmodel)
-            if data: output.append(data)
-          except:
-            if _debug: print "parseModel: invalid child model at "+path
-        elif not child.getchildren():
-          try:
-            if _debug: print "parseModel: calling parseModel for "+child.tag
-            #new instance just in case
-            parser=ModelParser(self.globalsources,self.localsources)
-            data=parser.parseModel(child)
-            if data: output.append(data)
-          except:
-            if _debug: print "parseModel: invalid child model "+child.tag
+        data=self.parseSubModel(child)
+        if data: output.append(data)
       else:
-        if _debug: print "parseModel: calling parseXML for "+child.tag
         self.level+=1
         data=self.parseXML(child)
         self.level-=1
         if data: output.append(data)
+      self.checkMemory()
     if doc.tail: output.append(doc.tail)
-    if output: data="".join(output)
-    else: data="No output was generated using the current model."
+    output=self.output=self.renderDeferred(output)
+    if not output.size: output.append("No output was generated using the current model.")
+    if key and not output.spilled():
+      self.outputs.add((output.getvalue(),list(self.dependencies)),key)
+      self.outputs.supersede(self.outputs.getkey(ElementTree.tostring(doc)),key)
+    if self.parent is None: self.closePools()
     file=doc.attrib.get("output")
     if file:
       fp=open(file,'w')
-      fp.write(data)
-    return data
+      for data in output.chunks():
+        fp.write(data)
+      fp.close()
+    if stream is None: return output.getvalue()
+    for data in output.chunks():
+      stream.write(data)
+    return None
+
+
+def renderModel(parser, path, echo=True):
+  """\brief Renders the model file at \em path with an existing parser
+
+  The parser is reset before use, so its conglomerator, sort and executor
+  caches stay warm between calls.  The output is written to standard out,
+  piece by piece, when \em echo is set or when the model has no \a output
+  attribute.  The files the model read are left in \a parser.dependencies.
+
+  \param parser The ModelParser instance to render with
+  \param path The filename of the model document
+  \param echo (True) Print the output even if it was written to a file
+  \return a string containing the final output of the model, or None when
+  it was printed
+  """
+  doc=ElementTree.parse(path).getroot()
+  parser.reset()
+  if echo or not doc.attrib.get("output"):
+    parser.parseModel(doc,sys.stdout)
+    print
+    return None
+  return parser.parseModel(doc)
+
+_shared=[] #sources of a forked findMatches worker, see _initShared()
+_deferred=[] #(parser, query) pairs of a forked query worker, see _initDeferred()
+_positions={} #index: {id(element): position} built lazily in each worker
+
+def _initShared(sources):
+  """\brief Keeps the sources a findMatches worker was forked with"""
+  _shared[:]=sources
+  _positions.clear()
+
+def _fillSlots(chunks, mark, results):
+  """\brief Yields \em chunks with every deferred query slot filled
+
+  A slot is a query number bracketed by \em mark, and may be split
+  across chunks, so text that could begin a mark is held back until the
+  next chunk shows whether it does.
+
+  \param chunks An iterable of output strings
+  \param mark The slot mark of the run, see ModelParser.deferQuery()
+  \param results The outputs of the deferred queries, by number
+  """
+  pending=""
+  for chunk in chunks:
+    pending+=chunk
+    while 1:
+      start=pending.find(mark)
+      if start<0:
+        keep=len(pending)-len(mark)+1
+        if keep>0:
+          yield pending[:keep]
+          pending=pending[keep:]
+        break
+      end=pending.find(mark,start+len(mark))
+      if end<0:
+        if start:
+          yield pending[:start]
+          pending=pending[start:]
+        break
+      if start: yield pending[:start]
+      yield results[int(pending[start+len(mark):end])] or ""
+      pending=pending[end+len(mark):]
+  if pending: yield pending
+
+def _initDeferred(contexts):
+  """\brief Keeps the deferred queries a query worker was forked with"""
+  _deferred[:]=contexts
+
+def _canonical(node):
+  """\brief Returns a comparable summary of the content of \em node"""
+  return (node.tag,sorted(node.items()),(node.text or "").strip(),
+      [_canonical(child) for child in node.getchildren()])
+
+def _findall(args):
+  """\brief Matches a path against one source in a pool thread"""
+  source, path = args
+  return source.findall(path)
+
+def _findallShared(args):
+  """\brief Matches a path against a source inherited by a forked worker
+
+  \return the document order positions of the matches
+  """
+  index, path = args
+  source=_shared[index]
+  positions=_positions.get(index)
+  if positions is None:
+    positions={}
+    for element in source.getiterator():
+      positions[id(element)]=len(positions)
+    _positions[index]=positions
+  return [positions[id(element)] for element in source.findall(path)]
+
+def _renderQuery(args):
+  """\brief Renders one deferred query with its forked parser context"""
+  parser, node = args
+  return parser.parseQuery(node)
+
+def _renderDeferred(index):
+  """\brief Renders a deferred query inherited by a forked worker"""
+  parser, node = _deferred[index]
+  parser.parallel="off" #pool workers cannot fork pools of their own
+  parser.pools={}
+  parser.poolLock=threading.Lock()
+  return parser.parseQuery(node)
+
+def _canFork():
+  """\brief Tells whether auto modes may fork worker processes
+
+  Forking is only worth it with several CPUs, and only safe while this
+  process runs no other thread: a thread of a threaded server, or of a
+  thread pool, could hold a lock that the forked child would inherit
+  locked.  Explicit "processes" modes still fork.
+  """
+  return _cpus()>1 and threading.activeCount()==1
+
+def _cpus():
+  """\brief Returns the number of CPUs, or 1 if it cannot be determined"""
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 1
+
+def expandModels(args):
+  """\brief Expands command line model arguments into a list of filenames
+
+  Each argument may be a filename or a glob pattern.  Patterns are
+  expanded in sorted order and filenames appearing more than once are
+  only kept the first time.
+
+  \param args A list of filenames or glob patterns
+  \return a list of model filenames
+  """
+  import glob
+  paths=[]
+  for arg in args:
+    matches=glob.glob(arg)
+    matches.sort()
+    if not matches: matches=[arg]
+    for path in matches:
+      if path not in paths: paths.append(path)
+  return paths
+
+def createParser(cachedir=None, profile=None, budget=None):
+  """\brief Creates a ModelParser configured from command line options
+
+  \param cachedir (None) Keep rendered outputs in this directory and reuse
+  them while the model and its sources are unchanged
+  \param profile (None) A profiler.Profiler to time the parser with
+  \param budget (None) The memory budget of each model run in bytes, see
+  ModelParser.checkMemory()
+  \return a new ModelParser instance
+  """
+  parser=ModelParser()
+  parser.memoryBudget=budget
+  if cachedir:
+    parser.cacheOutput=True
+    parser.outputs=cache.DiskCache(cachedir)
+  if profile:
+    profile.instrument(parser)
+  return parser
+
+_worker=None
+
+def _initWorker(cachedir=None, profile=None, budget=None):
+  """\brief Creates the per-process parser used by \em _renderWorker()"""
+  global _worker
+  _worker=createParser(cachedir, profile, budget)
+  _worker.conglomerator.shared=True
+
+def _renderWorker(path):
+  """\brief Renders one model in a pool worker
+
+  \param path The filename of the model document
+  \return a (path, output, error, sourcestats) tuple, output is None for
+  output= models
+  """
+  try:
+    doc=ElementTree.parse(path).getroot()
+    _worker.reset()
+    data=_worker.parseModel(doc)
+    if doc.attrib.get("output"): data=None
+    return (path,data,None,_worker.sourceStats)
+  except Exception, e:
+    return (path,None,str(e),_worker.sourceStats)
+
+def renderModels(paths, jobs=1, cachedir=None, profile=None, report=None,
+    budget=None):
+  """\brief Renders many models in one process or across a process pool
+
+  All models rendered by one process share a parser whose conglomerator
+  is in shared mode, so identical files and url source declarations are
+  loaded once per process instead of once per model.  With \em jobs
+  greater than one the models are spread over a multiprocessing pool.
+  Models with an \a output attribute write their file; the output of the
+  others is printed to standard out in the order given.
+
+  \param paths A list of model filenames
+  \param jobs (1) The number of worker processes to use
+  \param cachedir (None) The output cache directory, see \em createParser()
+  \param profile (None) A profiler.Profiler to time the models with; only
+  used when the models are rendered in this process
+  \param report (None) A list to append the source load statistics of
+  each model to, see \em writeSourceReport()
+  \param budget (None) The memory budget of each model run, see
+  \em createParser()
+  \return the number of models that failed to render
+  """
+  if jobs>1:
+    import multiprocessing
+    pool=multiprocessing.Pool(jobs,_initWorker,(cachedir,None,budget))
+    results=pool.imap(_renderWorker,paths)
+  else:
+    _initWorker(cachedir, profile, budget)
+    results=itertools.imap(_renderWorker,paths)
+  failed=0
+  for path, data, error, stats in results:
+    if report is not None: report.append({"model":path,"sources":stats})
+    if error:
+      print >>sys.stderr, "%s: %s"%(path,error)
+      failed+=1
+    elif data is not None:
+      print data
+  if jobs>1:
+    pool.close()
+    pool.join()
+  return failed
+
+def writeSourceReport(report, filename):
+  """\brief Writes the source load statistics of rendered models as JSON
+
+  The report is a list with one object per model, holding the \a model
+  filename and the list of its \a sources as recorded in
+  ModelParser.sourceStats.
+
+  \param report A list of {"model": path, "sources": stats} dictionaries
+  \param filename The name of the file to write, or "-" for standard error
+  """
+  import json
+  if filename=="-":
+    stream=sys.stderr
+  else:
+    stream=open(filename,"w")
+  try:
+    json.dump(report,stream,indent=1,sort_keys=True)
+    stream.write("\n")
+  finally:
+    if stream is not sys.stderr: stream.close()
+
+def watchModels(parser, paths, interval=1.0):
+  """\brief Renders \em paths, then re-renders them whenever they change
+
+  Every model is rendered once, after which its file, included models
+  and files source directories are polled every \em interval seconds.
+  Only models whose own dependencies changed are rendered again.  This
+  never returns; interrupt it to stop watching.
+
+  \param parser The ModelParser instance to render with
+  \param paths A list of model filenames
+  \param interval The number of seconds to wait between polls
+  """
+  import time, watcher
+  models=watcher.Watcher()
+  changed=paths
+  while 1:
+    for path in changed:
+      start=time.time()
+      try:
+        renderModel(parser,path,echo=False)
+        models.watch(path,[(path,False)]+parser.dependencies)
+      except Exception, e:
+        print >>sys.stderr, "%s: %s"%(path,e)
+        models.watch(path,[(path,False)])
+        continue
+      print >>sys.stderr, "%s: rendered in %.3fs"%(path,time.time()-start)
+    time.sleep(interval)
+    changed=models.changed()
 
 
 if __name__ == "__main__":
-  import sys
+  from optparse import OptionParser
 
-  if len(sys.argv) != 2:
-    print """
-          Usage: modelparser.py <model_definition.xml>
-          """
+  cmdline=OptionParser(usage="%prog [options] <model_definition.xml> [...]")
+  cmdline.add_option("-w","--watch",action="store_true",default=False,
+      help="keep running and re-render the model when it or its sources change")
+  cmdline.add_option("-i","--interval",type="float",default=1.0,
+      help="seconds between polls in watch mode (default 1.0)")
+  cmdline.add_option("-j","--jobs",type="int",default=1,
+      help="render several models across this many processes (default 1)")
+  cmdline.add_option("-c","--cache-dir",dest="cachedir",default=None,
+      help="reuse outputs stored here while the model and sources are unchanged")
+  cmdline.add_option("-P","--profile",default=None,
+      help="time every directive and write the profile to this file, "
+          "as JSON if it ends in .json, otherwise as folded flame graph stacks")
+  cmdline.add_option("-S","--source-report",dest="sourcereport",default=None,
+      help="write the load statistics of every source as JSON to this file "
+          "('-' for standard error); not written in watch mode")
+  cmdline.add_option("-M","--memory-budget",dest="budget",default=None,
+      help="the approximate memory a model run may use, such as 512M; over it "
+          "output spills to disk, caches are evicted and sources are projected")
+  options,args=cmdline.parse_args()
+
+  paths=expandModels(args)
+  if not paths:
+    cmdline.print_help()
     exit(2)
 
+  profile=None
+  if options.profile:
+    profile=profiler.Profiler()
+    options.jobs=1 #worker processes cannot report their timings
 
-  doc=ElementTree.XML(open(sys.argv[1],'r').read())
-  parser=ModelParser()
-  data=parser.parseModel(doc)
-  print data
+  budget=None
+  if options.budget:
+    budget=memory.parseSize(options.budget)
+
+  failed=0
+  report=[]
+  if options.watch:
+    try:
+      watchModels(createParser(options.cachedir,profile,budget),paths,
+          options.interval)
+    except KeyboardInterrupt:
+      pass
+  elif len(paths)==1:
+    parser=createParser(options.cachedir,profile,budget)
+    try:
+      renderModel(parser,paths[0])
+    except memory.MemoryBudgetError, e:
+      print >>sys.stderr, "%s: %s"%(paths[0],e)
+      failed=1
+    report.append({"model":paths[0],"sources":parser.sourceStats})
+  else:
+    failed=renderModels(paths,options.jobs,options.cachedir,profile,report,
+        budget)
+  if profile: profile.write(options.profile)
+  if options.sourcereport and not options.watch:
+    writeSourceReport(report,options.sourcereport)
+  exit(failed and 1)
@@ -0,0 +1,186 @@
+# \file profiler.py
+# (c) Matt Dugan
+#
+# \brief Measures the time spent on each directive of a model
+
+import time, threading, json
+
+# parse methods of ModelParser which are timed, by the directive they parse
+METHODS=("parseModel","parseSource","parseQuery","parseAction","parseGetNode",
+    "parseGetContent","parseLiteral","parseSubModel")
+
+class Profiler:
+  """\brief Measures the time spent on each directive of a model
+
+  A Profiler is attached to a ModelParser with \em instrument(), which
+  replaces the parse methods of that one parser object by timing
+  wrappers, so parsers without a profiler run exactly the code they
+  always did.  Each call is recorded against the stack of directives it
+  ran under, such as model;query#3(.//blog);action#4(sort);getnode#5(./post),
+  where the number is the position of the directive in its model
+  document.  For every stack the profiler keeps the number of calls, the
+  wall time including and excluding nested directives, the number of
+  items matched by getnode paths, and the bytes of output produced.
+
+  Calls made on other threads (parallel queries or sources) are recorded
+  on stacks of their own.  Queries rendered in worker processes could not
+  be recorded, so an instrumented parser renders them on threads.
+  """
+
+  def __init__(self):
+    """\brief Initializes an empty Profiler"""
+    self.stats={} #stack: [calls, wall, self, items, bytes]
+    self.labels={} #id(node): (node, label)
+    self.lock=threading.Lock()
+    self.local=threading.local()
+
+  def instrument(self, parser):
+    """\brief Times the parse methods of \em parser
+
+    \param parser The ModelParser to profile
+    \return the parser
+    """
+    parser.profiler=self
+    if parser.parallelQueries!="off": parser.parallelQueries="threads"
+    for name in METHODS:
+      method=getattr(parser.__class__, name)
+      setattr(parser, name, self._wrap(parser, method))
+    findMatches=parser.__class__.findMatches
+    def countMatches(*args, **kwargs):
+      items=findMatches(parser, *args, **kwargs)
+      self.count(len(items))
+      return items
+    parser.findMatches=countMatches
+    return parser
+
+  def _wrap(self, parser, method):
+    """\brief Returns \em method bound to \em parser, timed"""
+    profiler=self
+    def timed(node, *args, **kwargs):
+      if method.__name__=="parseModel": profiler.prepare(node)
+      frame=profiler.enter(node)
+      data=None
+      try:
+        data=method(parser, node, *args, **kwargs)
+      finally:
+        profiler.leave(frame, data)
+      return data
+    return timed
+
+  def prepare(self, doc):
+    """\brief Labels every directive of the model \em doc
+
+    \param doc The root of a model document
+    """
+    count=0
+    for node in doc.getiterator():
+      count+=1
+      if not self.labels.has_key(id(node)):
+        self.labels[id(node)]=(node, self._label(node, count))
+
+  def _label(self, node, number):
+    """\brief Returns the name \em node is reported under"""
+    tag=node.tag
+    if not isinstance(tag, basestring): return "node#%d"%number
+    tag=tag.split("}")[-1]
+    detail=node.attrib.get("path") or node.attrib.get("name") or \
+        node.attrib.get("type") or ""
+    label="%s#%d"%(tag, number)
+    if detail: label="%s(%s)"%(label, detail)
+    return label.replace(";", ",").replace(" ", "_")
+
+  def enter(self, node):
+    """\brief Starts timing a call for \em node
+
+    \return a frame to hand to \em leave()
+    """
+    stack=getattr(self.local, "stack", None)
+    if stack is None: stack=self.local.stack=[]
+    entry=self.labels.get(id(node))
+    if entry is None:
+      label=self._label(node, 0)
+    else:
+      label=entry[1]
+    if stack: path=stack[-1][0]+";"+label
+    else: path=label
+    frame=[path, time.time(), 0.0, 0] #stack, start, nested time, items
+    stack.append(frame)
+    return frame
+
+  def leave(self, frame, data):
+    """\brief Records the call timed by \em frame, which produced \em data"""
+    stack=self.local.stack
+    stack.pop()
+    elapsed=time.time()-frame[1]
+    if stack: stack[-1][2]+=elapsed
+    self.lock.acquire()
+    try:
+      stats=self.stats.get(frame[0])
+      if stats is None: stats=self.stats[frame[0]]=[0, 0.0, 0.0, 0, 0]
+      stats[0]+=1
+      stats[1]+=elapsed
+      stats[2]+=elapsed-frame[2]
+      stats[3]+=frame[3]
+      if isinstance(data, basestring): stats[4]+=len(data)
+    finally:
+      self.lock.release()
+
+  def count(self, items):
+    """\brief Adds \em items matched items to the current call"""
+    stack=getattr(self.local, "stack", None)
+    if stack: stack[-1][3]+=items
+
+  def report(self):
+    """\brief Returns the recorded statistics, slowest stacks first
+
+    \return a list of dictionaries with the keys stack, directive, calls,
+    wall, self (both in seconds), items and bytes
+    """
+    self.lock.acquire()
+    try:
+      stats=self.stats.items()
+    finally:
+      self.lock.release()
+    rows=[]
+    for stack, (calls, wall, own, items, size) in stats:
+      rows.append({"stack":stack, "directive":stack.split(";")[-1],
+          "calls":calls, "wall":wall, "self":own, "items":items,
+          "bytes":size})
+    rows.sort(key=lambda row: row["wall"], reverse=True)
+    return rows
+
+  def writeJSON(self, stream):
+    """\brief Writes \em report() to \em stream as JSON
+
+    \param stream A file-like object to write to
+    """
+    json.dump(self.report(), stream, indent=1, sort_keys=True)
+    stream.write("\n")
+
+  def writeFolded(self, stream):
+    """\brief Writes the self times in the folded stack format
+
+    Each line holds a stack and its self time in microseconds, the input
+    format of flamegraph.pl and compatible flame graph viewers.
+
+    \param stream A file-like object to write to
+    """
+    rows=self.report()
+    rows.sort(key=lambda row: row["stack"])
+    for row in rows:
+      stream.write("%s %d\n"%(row["stack"], int(row["self"]*1000000)))
+
+  def write(self, filename):
+    """\brief Writes the profile to \em filename
+
+    Files ending in .json get the JSON report, any other the folded
+    stacks.
+
+    \param filename The name of the file to write
+    """
+    stream=open(filename, "w")
+    try:
+      if filename.endswith(".json"): self.writeJSON(stream)
+      else: self.writeFolded(stream)
+    finally:
+      stream.close()
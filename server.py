@@ -0,0 +1,209 @@
+#!/bin/env python
+# \file server.py
+# (c) Matt Dugan
+#
+# \brief Serves rendered XDRA models over HTTP
+
+import os, sys, time, threading, Queue, urllib
+import BaseHTTPServer, SocketServer
+import xmlio as ElementTree
+import watcher, cache
+from modelparser import ModelParser
+
+class RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """\brief Answers GET requests with the output of the requested model
+
+  The URL path is taken relative to the server's model root, so a request
+  for /blog/model3.xml renders <root>/blog/model3.xml.  Every response
+  carries X-Render-Time (seconds spent producing the body) and X-Cache
+  (hit or miss) headers, and the same timing is written to the log.  The
+  output is complete, and cached, before the response starts, so it is
+  sent in one piece with a Content-Length.
+  """
+
+  protocol_version="HTTP/1.1"
+
+  def do_GET(self):
+    """\brief Renders or fetches from cache the model named by the URL"""
+    start=time.time()
+    path=self.server.resolve(self.path)
+    if not path:
+      self.send_error(404, "No such model")
+      return
+    try:
+      data, hit = self.server.render(path)
+    except Exception, e:
+      self.send_error(500, "Model failed to render: %s"%e)
+      return
+    elapsed=time.time()-start
+    self.send_response(200)
+    if isinstance(data, unicode): data=data.encode("utf-8")
+    self.send_header("Content-Type", self.server.contentType(data))
+    self.send_header("Content-Length", str(len(data)))
+    self.send_header("X-Render-Time", "%.6f"%elapsed)
+    self.send_header("X-Cache", hit and "hit" or "miss")
+    self.end_headers()
+    self.wfile.write(data)
+    self.log_message('"%s" %s %d bytes in %.3fms', self.requestline,
+        hit and "hit" or "miss", len(data), elapsed*1000.0)
+
+  def log_request(self, code='-', size='-'):
+    """\brief Skips the default request line, do_GET logs its own timing"""
+    pass
+
+  def log_message(self, format, *args):
+    """\brief Logs to standard error unless the server is quiet"""
+    if not self.server.quiet:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class RenderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """\brief A threaded HTTP server rendering XDRA models on request
+
+  The server keeps a pool of \em ModelParser instances which share one
+  parsed file cache, so source files are only parsed again after they
+  change on disk.  Rendered output is kept for \a ttl seconds and is only
+  reused while the model file and every files source and included model
+  it read still carry the same stamp.  Once the ttl runs out the parsers'
+  shared output cache is consulted, which revalidates the model against
+  the fingerprints of all its sources (see ModelParser.fingerprint())
+  before rendering it again.  Requests are rendered in parallel on their
+  own threads, so the parsers neither fan out nor fork workers of their
+  own.  Both caches keep at most \a maxoutputs
+  outputs, dropping the least recently used, and a model's output is
+  replaced rather than added to when its sources change.
+  """
+
+  daemon_threads=True
+  allow_reuse_address=True
+
+  def __init__(self, address, root, parsers=4, ttl=60.0, quiet=False,
+      maxoutputs=1000):
+    """\brief Initializes the server, its parser pool and output cache
+
+    \param address A (host, port) pair to listen on
+    \param root The directory models are served from
+    \param parsers (4) The number of warm parsers kept in the pool
+    \param ttl (60.0) Seconds a rendered output may be served from cache
+    \param quiet (False) Suppress the per-request log lines
+    \param maxoutputs (1000) The most rendered outputs to keep
+    """
+    BaseHTTPServer.HTTPServer.__init__(self, address, RenderHandler)
+    self.root=os.path.abspath(root)
+    self.ttl=ttl
+    self.quiet=quiet
+    self.pool=Queue.Queue()
+    treecache=cache.LRUDict(10000)
+    outputs=cache.Cache(maxoutputs)
+    for count in range(parsers):
+      parser=ModelParser()
+      parser.conglomerator.treecache=treecache
+      parser.cacheOutput=True
+      parser.outputs=outputs
+      parser.parallel="off" #requests already run in parallel, and a
+      parser.parallelQueries="off" #threaded server must not fork workers
+      self.pool.put(parser)
+    self.outputs=cache.LRUDict(maxoutputs) #path: (expires, dependencies, version, data)
+    self.lock=threading.Lock()
+
+  def resolve(self, url):
+    """\brief Maps a request path onto a model file below the root
+
+    \param url The path component of the request
+    \return the model filename, or None if it is not a servable model
+    """
+    url=urllib.unquote(url.split("?",1)[0])
+    path=os.path.abspath(os.path.join(self.root, url.lstrip("/")))
+    if not path.startswith(self.root+os.sep): return None
+    if not (path.endswith(".xml") and os.path.isfile(path)): return None
+    return path
+
+  def render(self, path):
+    """\brief Returns the output of the model at \em path
+
+    A cached output is used if it has not expired and the stamps of the
+    files it was rendered from are unchanged.  Otherwise a parser is taken
+    from the pool, the model is rendered and the result cached.
+
+    \param path The model filename, as returned by \em resolve()
+    \return an (output, hit) pair where hit is True for a cached output
+    """
+    self.lock.acquire()
+    try:
+      cached=self.outputs.get(path)
+    finally:
+      self.lock.release()
+    if cached:
+      expires, dependencies, version, data = cached
+      if expires>time.time() and version==self._version(dependencies):
+        return data, True
+    parser=self.pool.get()
+    try:
+      doc=ElementTree.parse(path).getroot()
+      parser.reset()
+      data=parser.parseModel(doc)
+      dependencies=[(path,False)]+parser.dependencies
+    finally:
+      self.pool.put(parser)
+    version=self._version(dependencies)
+    self.lock.acquire()
+    try:
+      self.outputs[path]=(time.time()+self.ttl, dependencies, version, data)
+    finally:
+      self.lock.release()
+    return data, False
+
+  def contentType(self, data):
+    """\brief Guesses the content type of a rendered output
+
+    \param data The rendered output
+    \return a MIME type string
+    """
+    if data[:200].lower().find("<html")>=0:
+      return "text/html"
+    if data.lstrip()[:1]=="<":
+      return "text/xml"
+    return "text/plain"
+
+  def _version(self, dependencies):
+    """\brief Stamps every (path, recursive) pair in \em dependencies"""
+    return tuple([watcher.stamp(path, recursive)
+        for path, recursive in dependencies])
+
+def serve(root, host="127.0.0.1", port=8000, parsers=4, ttl=60.0):
+  """\brief Serves the models below \em root until interrupted
+
+  \param root The directory models are served from
+  \param host ("127.0.0.1") The address to listen on
+  \param port (8000) The port to listen on
+  \param parsers (4) The number of warm parsers kept in the pool
+  \param ttl (60.0) Seconds a rendered output may be served from cache
+  """
+  server=RenderServer((host, port), root, parsers, ttl)
+  print >>sys.stderr, "Serving models from %s on http://%s:%d/"%(
+      server.root, host, port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+
+
+if __name__ == "__main__":
+  from optparse import OptionParser
+
+  cmdline=OptionParser(usage="%prog [options] [model_root]")
+  cmdline.add_option("-H","--host",default="127.0.0.1",
+      help="address to listen on (default 127.0.0.1)")
+  cmdline.add_option("-p","--port",type="int",default=8000,
+      help="port to listen on (default 8000)")
+  cmdline.add_option("-n","--parsers",type="int",default=4,
+      help="number of warm parsers to keep (default 4)")
+  cmdline.add_option("-t","--ttl",type="float",default=60.0,
+      help="seconds to serve a cached output (default 60)")
+  options,args=cmdline.parse_args()
+
+  if len(args) > 1:
+    cmdline.print_help()
+    exit(2)
+  serve(args and args[0] or ".", options.host, options.port,
+      options.parsers, options.ttl)
@@ -0,0 +1,54 @@
+#!/bin/env python
+# \file servertest.py
+# (c) Matt Dugan
+#
+# \brief Exercises server.py locally on an ephemeral port
+
+import threading, httplib
+from server import RenderServer
+
+def request(port, url):
+  """\brief Fetches \em url from the local server
+
+  \return a (status, headers, body) tuple
+  """
+  connection=httplib.HTTPConnection("127.0.0.1", port)
+  try:
+    connection.request("GET", url)
+    response=connection.getresponse()
+    return response.status, dict(response.getheaders()), response.read()
+  finally:
+    connection.close()
+
+def check(name, condition):
+  """\brief Prints the outcome of one check and stops on a failure"""
+  print "%s: %s"%(name, condition and "ok" or "FAILED")
+  if not condition: raise SystemExit(1)
+
+if __name__ == "__main__":
+  """\brief test main for the model server
+
+  Starts a RenderServer on an ephemeral port serving the samples directory
+  (models are rendered from the current directory, so run this from the
+  top of the source tree), then checks a render, a cached render, the
+  length of a response and that paths outside the root are not served.
+  """
+  server=RenderServer(("127.0.0.1", 0), "samples", parsers=2, quiet=True)
+  port=server.server_address[1]
+  thread=threading.Thread(target=server.serve_forever)
+  thread.setDaemon(True)
+  thread.start()
+  try:
+    status, headers, body = request(port, "/model1.xml")
+    check("render", status==200 and body.find("Title4")>=0)
+    check("miss", headers.get("x-cache")=="miss")
+    check("length", headers.get("content-length")==str(len(body)))
+    check("timing", float(headers.get("x-render-time", "-1"))>=0)
+    status, headers, again = request(port, "/model1.xml")
+    check("hit", status==200 and headers.get("x-cache")=="hit" and again==body)
+    for url in ("/../servertest.py", "/%2e%2e/README.md", "/data/1.xml.missing"):
+      status, headers, body = request(port, url)
+      check("404 %s"%url, status==404)
+  finally:
+    server.shutdown()
+    server.server_close()
@@ -4,6 +4,8 @@
 # \brief Sorts a list of XML objects according to a common key node
 
 import xmlio as ElementTree
+import elementpath, hooks
+import heapq, itertools, tempfile, cPickle
 
 class Sort:
 	"""\brief Sorts a list of XML objects according to a common key node
@@ -12,9 +14,67 @@ class Sort:
 	the ModelParser in response to the \a sort and \a reversesort attributes
 	of the xdra:action directive in a xdra:model.  In either case the datalist
 	is sorted according to the value of the text contents of a key node.
+
+	Extracted keys are kept in \a columns, one column per key name and key
+	type, so that several queries sorting the same source by the same key
+	only search each item for its key once.  Columns hold a reference to
+	every item they describe and must be dropped with \em invalidate()
+	whenever items may have been modified.
 	"""
 
-	def sort(self, datalist, key, reverse):
+	def __init__(self):
+		"""\brief Initializes a Sort with no extracted key columns"""
+		self.columns={} #(key, keytype): {id(item): (item, value)}
+
+	def keys(self, datalist, key, keytype="text"):
+		"""\brief Returns the typed key value of every item in \a datalist
+
+		Values are taken from the column for \a key and \a keytype when the
+		item has been seen before, and otherwise extracted and added to it.
+		A \em text key is the lowercased text of the first descendant named
+		\a key, an \em exact key is that text unchanged, and a \em number key
+		sorts numeric values first, by value, followed by the rest as text.
+
+		\param datalist a list of nodes
+		\param key the tag name of the key node
+		\param keytype ("text") one of "text", "exact" or "number"
+		\return a list of key values, in the order of \a datalist
+		"""
+		column=self.columns.get((key,keytype))
+		if column is None:
+			column=self.columns[(key,keytype)]={}
+		path=None
+		values=[]
+		extracted=0
+		for item in datalist:
+			entry=column.get(id(item))
+			if entry is None:
+				if path is None: path=elementpath.compile(".//"+key)
+				entry=(item,self._convert(path.findtext(item),keytype))
+				column[id(item)]=entry
+				extracted+=1
+			values.append(entry[1])
+		if hooks.enabled: hooks.emit("sort.keys",key=key,keytype=keytype, \
+				items=len(values),extracted=extracted)
+		return values
+
+	def invalidate(self):
+		"""\brief Drops every extracted key column"""
+		self.columns={}
+
+	def _convert(self, text, keytype):
+		"""\brief Turns the text of a key node into a key of \a keytype"""
+		text=text or ""
+		if keytype=="number":
+			try:
+				return (0,float(text))
+			except ValueError:
+				return (1,text.lower())
+		if keytype=="exact":
+			return text
+		return text.lower()
+
+	def sort(self, datalist, key, reverse, keytype="text"):
 		"""\brief Sorts a list of XML objects by the text value of child <key>
 
 		\em sort() performs either an ascending or descending sort of
@@ -29,18 +89,77 @@ class Sort:
 		\param datalist a list of nodes in response to a query/action/getnode triplet
 		\param key the tag name of the node to sort against
 		\param reverse boolean flag controlling ascending (False) or descending sorts
+		\param keytype ("text") how key values compare, see \em keys()
 		"""
 		if len(datalist) > 1:
-			if reverse:
-				#descending sort
-				datalist.sort(lambda x, y: cmp(y.findtext(".//"+key).lower(), \
-						x.findtext(".//"+key).lower()))
-				#datalist.reverse() not needed when you switch x and y!
-				return datalist
-			else:
-				#ascending sort
-				datalist.sort(lambda x, y: cmp(x.findtext(".//"+key).lower(), \
-						y.findtext(".//"+key).lower()))
-				return datalist
-		else:
-			return datalist
+			values=self.keys(datalist,key,keytype)
+			order=sorted(range(len(datalist)),key=values.__getitem__, \
+					reverse=reverse)
+			datalist[:]=[datalist[index] for index in order]
+		return datalist
+
+	def spill(self, items, key, reverse, keytype="text", runsize=100000):
+		"""\brief Sorts any number of XML objects with bounded memory
+
+		\em spill() is an external merge sort.  Items are pulled from the
+		iterable \a items and their keys extracted as in \em keys(), until
+		\a runsize of them are held.  That run is sorted and written to a
+		temporary file as serialized items, and the next run begun.  The
+		sorted runs are then merged, reading one item at a time from each,
+		so that at most \a runsize items are in memory whatever the size of
+		the input.  If everything fits in a single run nothing is written and
+		the original items are returned.  Items read back from a run are new
+		elements parsed from its file.  Equal keys keep their input order.
+
+		\param items an iterable of nodes
+		\param key the tag name of the node to sort against
+		\param reverse boolean flag controlling ascending (False) or descending sorts
+		\param keytype ("text") how key values compare, see \em keys()
+		\param runsize (100000) the number of items held in memory at once
+		\return an iterator over the nodes in key order
+		"""
+		path=elementpath.compile(".//"+key)
+		run=[]
+		runs=[]
+		for position, item in enumerate(items):
+			value=self._convert(path.findtext(item),keytype)
+			if reverse: value=_Descending(value)
+			run.append((value,position,item))
+			if len(run)>=runsize:
+				runs.append(self._writeRun(run))
+				run=[]
+		run.sort()
+		if hooks.enabled: hooks.emit("sort.spill",key=key,runs=len(runs)+1, \
+				runsize=runsize)
+		if not runs:
+			return iter([item for value, position, item in run])
+		if run:
+			runs.append(self._writeRun(run))
+		return (ElementTree.XML(text) for value, position, text in \
+				heapq.merge(*[self._readRun(stream) for stream in runs]))
+
+	def _writeRun(self, run):
+		"""\brief Sorts \a run and writes it to a new temporary file"""
+		run.sort()
+		stream=tempfile.TemporaryFile()
+		for value, position, item in run:
+			cPickle.dump((value,position,ElementTree.tostring(item)),stream,2)
+		stream.seek(0)
+		return stream
+
+	def _readRun(self, stream):
+		"""\brief Yields the records of a run file, closing it at the end"""
+		try:
+			while 1:
+				yield cPickle.load(stream)
+		except EOFError:
+			stream.close()
+
+class _Descending:
+	"""\brief Wraps a key value so that it compares in reverse order"""
+
+	def __init__(self, value):
+		self.value=value
+
+	def __cmp__(self, other):
+		return cmp(other.value,self.value)
@@ -112,3 +112,48 @@ if __name__ == "__main__":
   data=parser.parseModel(doc)
   print "result=",data
   parser.reset()
+  print "\n----------------------\nParsing doc8\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model10.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc9\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model11.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc10\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model12.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc11\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model13.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc12\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model14.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc13\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model15.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc14\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model16.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc15\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model17.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
+  print "\n----------------------\nParsing doc16\n----------------------\n"
+  doc=ElementTree.XML(open('samples/model18.xml','r').read())
+  data=parser.parseModel(doc)
+  print "result=",data
+  parser.reset()
@@ -0,0 +1,114 @@
+# \file watcher.py
+# (c) Matt Dugan
+#
+# \brief Polls model and source paths for changes on disk
+
+import os, glob, operator
+
+class Watcher:
+  """\brief Polls model and source paths for changes on disk
+
+  The Watcher keeps a stamp (modification times and sizes) for every path
+  a model depends on: the model file itself, included child models, and
+  the directories given to files sources.  Each watched path belongs to an
+  \em owner, normally the model filename, so that a call to \em changed()
+  reports exactly which models need to be rendered again.  Directories are
+  stamped by the .xml files they contain, matching the way
+  conglomerator.FileInput collects them, so adding, removing or editing a
+  source file is noticed without any platform specific notification API.
+  """
+
+  def __init__(self):
+    """\brief Initializes an empty Watcher
+
+    \a paths maps each owner to the list of (path, recursive) pairs it
+    depends on, and \a stamps holds the last seen stamp for each pair.
+    """
+    self.paths={}
+    self.stamps={}
+
+  def watch(self, owner, paths):
+    """\brief Replaces the set of paths watched on behalf of \em owner
+
+    The current stamp of every path is recorded immediately, so changes
+    are reported relative to the moment \em watch() was called.
+
+    \param owner The object to report when one of its paths changes
+    \param paths A list of (path, recursive) pairs
+    """
+    self.paths[owner]=list(paths)
+    for entry in paths:
+      self.stamps[entry]=self._stamp(entry)
+
+  def unwatch(self, owner):
+    """\brief Stops watching the paths of \em owner
+
+    \param owner The owner given to a previous call of \em watch()
+    """
+    try:
+      del self.paths[owner]
+    except KeyError:
+      return
+
+  def changed(self):
+    """\brief Returns the owners whose paths changed since the last poll
+
+    Every watched path is stamped again and compared to the stored stamp.
+    Paths shared between owners are only stamped once per poll.
+
+    \return a list of owners, in no particular order
+    """
+    fresh={}
+    owners=[]
+    for owner, paths in self.paths.items():
+      for entry in paths:
+        if not fresh.has_key(entry):
+          fresh[entry]=self._stamp(entry)
+        if fresh[entry]!=self.stamps.get(entry):
+          owners.append(owner)
+          break
+    self.stamps.update(fresh)
+    return owners
+
+  def _stamp(self, entry):
+    """\brief Computes the stamp of a single (path, recursive) pair
+
+    \param entry A (path, recursive) pair
+    \return a hashable value which changes when the path changes
+    """
+    return stamp(entry[0],entry[1])
+
+def stamp(path, recursive=False):
+  """\brief Computes a stamp for a file or a files source directory
+
+  Files are stamped by their modification time and size.  Directories
+  are stamped by the sorted names, times and sizes of the .xml files they
+  contain, descending into sub-directories when \em recursive is set.
+
+  \param path The file or directory to stamp
+  \param recursive (False) Include .xml files below sub-directories
+  \return a hashable value which changes when the path changes
+  """
+  if not os.path.isdir(path):
+    try:
+      st=os.stat(path)
+      return (st.st_mtime,st.st_size)
+    except OSError:
+      return None
+  if recursive:
+    files=[]
+    for root, dirs, names in os.walk(path):
+      for name in names:
+        if name.endswith('.xml'):
+          files.append(os.path.join(root, name))
+  else:
+    files=glob.glob(os.path.normpath(operator.concat(path, '/*.xml')))
+  files.sort()
+  stamps=[]
+  for filename in files:
+    try:
+      st=os.stat(filename)
+      stamps.append((filename,st.st_mtime,st.st_size))
+    except OSError:
+      pass
+  return tuple(stamps)